@@ -0,0 +1,309 @@
+#! /usr/bin/env python
+
+"""benchmark.py: times pandoc-theoremnos on synthetic documents."""
+
+
+# Copyright 2015-2019 Thomas J. Duck and Johannes Schlatow
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# OVERVIEW
+#
+# Synthetic pandoc ASTs are generated for every combination of the
+# requested document parameters (number of theorems, theorem types,
+# references per theorem, nesting depth, filler paragraphs and runs of
+# consecutive theorems).  Each document is filtered for each output
+# format.  The end-to-end time through main() is measured, as is the time
+# taken by each pass:
+#
+#   json_load   - decoding the document
+#   metadata    - processing the metadata
+#   first_pass  - the walk that numbers the theorems
+#   walk:<name> - each of the second-pass (reference) walks
+#   add_tex     - adding the TeX header-includes (LaTeX/beamer only)
+#   json_dump   - encoding the document
+#
+# The minimum and median of the repeated timings (in seconds) are written
+# as JSON so that runs can be compared.  Use --help for the options.
+
+# pylint: disable=invalid-name
+
+import os
+import sys
+import io
+import json
+import time
+import random
+import platform
+import argparse
+import itertools
+
+from pandocfilters import walk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+# pylint: disable=wrong-import-position
+import pandoc_theoremnos
+from pandoc_theoremnos import TheoremProcessor
+
+# The pandoc version and API version of the generated documents
+PANDOCVERSION = '2.7.3'
+API_VERSION = [1, 17, 5, 4]
+
+# Theorem types used in the generated documents
+TYPES = [('thm', 'Theorem'), ('lem', 'Lemma'), ('def', 'Definition'),
+         ('cor', 'Corollary'), ('prop', 'Proposition'), ('ex', 'Exercise')]
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+# Document generation --------------------------------------------------------
+
+def _str(s):
+    """Returns a Str element."""
+    return {'t': 'Str', 'c': s}
+
+def _words(n):
+    """Returns n words of filler inlines."""
+    inlines = []
+    for i in range(n):
+        if inlines:
+            inlines.append({'t': 'Space'})
+        inlines.append(_str('word%d' % i))
+    return inlines
+
+def _cite(label):
+    """Returns a Cite element referencing `label`."""
+    citation = {'citationId': label, 'citationPrefix': [],
+                'citationSuffix': [],
+                'citationMode': {'t': 'AuthorInText'},
+                'citationNoteNum': 0, 'citationHash': 0}
+    return {'t': 'Cite', 'c': [[citation], [_str('@' + label)]]}
+
+def _meta_str(s):
+    """Returns a MetaInlines element."""
+    return {'t': 'MetaInlines', 'c': [_str(s)]}
+
+# pylint: disable=too-many-arguments, too-many-locals
+def make_document(theorems, types, refs, depth, paras, run=1, sections=10,
+                  seed=0):
+    """Returns a synthetic document AST.
+
+    There are `theorems` theorems cycling through `types` theorem types,
+    in runs of `run` consecutive theorems in a definition list.  Each run
+    is followed by a paragraph per theorem with `refs` references to
+    randomly chosen theorems, and by `paras` filler paragraphs per theorem.
+    Everything is nested within `depth` block quotes.  Runs are divided
+    among `sections` level-1 sections."""
+
+    rand = random.Random(seed)
+
+    if types <= len(TYPES):
+        types = TYPES[:types]
+    else:
+        types = TYPES + [('t%d' % i, 'Type%d' % i)
+                         for i in range(len(TYPES), types)]
+
+    labels = ['%s:%d' % (types[i % len(types)][0], i)
+              for i in range(theorems)]
+
+    blocks = []
+    runs = [labels[i:i+run] for i in range(0, theorems, run)]
+    per_section = max(1, len(runs) // max(1, sections))
+    for i, chunk in enumerate(runs):
+        if i % per_section == 0:
+            blocks.append({'t': 'Header',
+                           'c': [1, ['sec%d' % i, [], []], _words(2)]})
+        items = []
+        for label in chunk:
+            term = [{'t': 'Span', 'c': [[label, [], []], _words(2)]}]
+            items.append([term, [[{'t': 'Para', 'c': _words(10)}]]])
+        group = [{'t': 'DefinitionList', 'c': items}]
+        for _ in range(len(chunk) if refs else 0):
+            inlines = [_str('See')]
+            for _ in range(refs):
+                inlines += [{'t': 'Space'}, _cite(rand.choice(labels))]
+            group.append({'t': 'Para', 'c': inlines})
+        for _ in range(paras*len(chunk)):
+            group.append({'t': 'Para', 'c': _words(40)})
+        for _ in range(depth):
+            group = [{'t': 'BlockQuote', 'c': group}]
+        blocks += group
+
+    meta = {'theoremnos-names':
+                {'t': 'MetaList',
+                 'c': [{'t': 'MetaMap',
+                        'c': {'id': _meta_str(thid),
+                              'name': _meta_str(name)}}
+                       for thid, name in types]},
+            'xnos-warning-level': {'t': 'MetaString', 'c': '0'}}
+
+    return {'pandoc-api-version': API_VERSION, 'meta': meta,
+            'blocks': blocks}
+
+
+# Timing ---------------------------------------------------------------------
+
+def time_main(text, fmt, jobs=1):
+    """Returns the time taken to filter `text` through main() using `jobs`
+    processes."""
+    argv = sys.argv
+    sys.argv = ['pandoc-theoremnos', fmt, '--pandocversion', PANDOCVERSION,
+                '--no-cache', '--jobs', str(jobs)]
+    try:
+        stdin, stdout = io.StringIO(text), io.StringIO()
+        start = clock()
+        pandoc_theoremnos.main(stdin, stdout)
+        return clock() - start
+    finally:
+        sys.argv = argv
+
+def time_passes(text, fmt):
+    """Returns a dict of the times taken by each pass when filtering
+    `text`.  The passes are run in the same way as
+    TheoremProcessor.process_document()."""
+
+    times = {}
+    processor = TheoremProcessor()
+
+    start = clock()
+    doc = json.loads(text)
+    times['json_load'] = clock() - start
+
+    start = clock()
+    processor.reset()
+    processor.init_pandocxnos(PANDOCVERSION, doc)
+    meta, blocks = doc['meta'], doc['blocks']
+    processor.process(meta)
+    processor.load_index()
+    times['metadata'] = clock() - start
+
+    start = clock()
+    blocks = walk(blocks, processor.process_theorems, fmt, meta)
+    times['first_pass'] = clock() - start
+
+    for action in processor.refs_actions(fmt):
+        start = clock()
+        blocks = walk(blocks, action, fmt, meta)
+        times['walk:' + action.__name__] = clock() - start
+
+    if fmt in ['latex', 'beamer']:
+        start = clock()
+        processor.add_tex(meta)
+        times['add_tex'] = clock() - start
+
+    doc['blocks'] = blocks
+    start = clock()
+    json.dumps(doc)
+    times['json_dump'] = clock() - start
+
+    return times, len(processor.targets)
+
+def _summarize(samples):
+    """Returns the minimum and median of `samples`."""
+    samples = sorted(samples)
+    n = len(samples)
+    median = samples[n//2] if n % 2 else (samples[n//2-1]+samples[n//2])/2
+    return {'min': samples[0], 'median': median}
+
+def run_case(text, fmt, repeat, jobs=1):
+    """Times filtering `text` for the output format `fmt` `repeat` times.
+    Returns a dict of results."""
+    end_to_end = []
+    passes = {}
+    for _ in range(repeat):
+        end_to_end.append(time_main(text, fmt, jobs))
+        times, ntheorems = time_passes(text, fmt)
+        for name, t in times.items():
+            passes.setdefault(name, []).append(t)
+    return {'theorems_found': ntheorems,
+            'main': _summarize(end_to_end),
+            'passes': dict((name, _summarize(samples))
+                           for name, samples in passes.items())}
+
+
+# Main program ---------------------------------------------------------------
+
+def _intlist(s):
+    """Parses a comma-separated list of integers."""
+    return [int(x) for x in s.split(',')]
+
+def main():
+    """Runs the benchmarks."""
+
+    parser = argparse.ArgumentParser(\
+      description='Benchmarks pandoc-theoremnos on synthetic documents.  '
+      'Options taking lists are comma-separated; every combination is run.')
+    parser.add_argument('--theorems', type=_intlist, default=[100, 1000],
+                        help='Numbers of theorems (default 100,1000).')
+    parser.add_argument('--types', type=_intlist, default=[4],
+                        help='Numbers of theorem types (default 4).')
+    parser.add_argument('--refs', type=_intlist, default=[2],
+                        help='References per theorem (default 2).')
+    parser.add_argument('--depth', type=_intlist, default=[0],
+                        help='Block quote nesting depths (default 0).')
+    parser.add_argument('--paras', type=_intlist, default=[1],
+                        help='Filler paragraphs per theorem (default 1).')
+    parser.add_argument('--run', type=_intlist, default=[1],
+                        help='Consecutive theorems per definition list '
+                        '(default 1).')
+    parser.add_argument('--formats', type=lambda s: s.split(','),
+                        default=['html', 'latex'],
+                        help='Output formats (default html,latex).')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per case (default 5).')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Processes for the reference passes through '
+                        'main() (default 1).')
+    parser.add_argument('--output', '-o',
+                        help='Write the results to this file '
+                        '(default stdout).')
+    args = parser.parse_args()
+
+    results = []
+    for theorems, types, refs, depth, paras, run in itertools.product(
+            args.theorems, args.types, args.refs, args.depth, args.paras,
+            args.run):
+        text = json.dumps(make_document(theorems, types, refs, depth, paras,
+                                        run))
+        for fmt in args.formats:
+            result = {'theorems': theorems, 'types': types, 'refs': refs,
+                      'depth': depth, 'paras': paras, 'run': run,
+                      'format': fmt, 'size': len(text)}
+            result.update(run_case(text, fmt, args.repeat, args.jobs))
+            results.append(result)
+            sys.stderr.write('%(format)s theorems=%(theorems)d '
+                             'types=%(types)d refs=%(refs)d depth=%(depth)d '
+                             'paras=%(paras)d run=%(run)d: ' % result)
+            sys.stderr.write('%.4fs\n' % result['main']['min'])
+
+    report = {'version': pandoc_theoremnos.__version__,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'repeat': args.repeat,
+              'jobs': args.jobs,
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
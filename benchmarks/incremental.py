@@ -0,0 +1,208 @@
+#! /usr/bin/env python
+
+"""incremental.py: checks IncrementalProcessor against full runs."""
+
+
+# Copyright 2015-2019 Thomas J. Duck and Johannes Schlatow
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# OVERVIEW
+#
+# IncrementalProcessor reuses the work done for the blocks of the previous
+# version of a document.  This check makes sure that it never changes the
+# output.  Random documents are generated with sections, tagged, titled,
+# nested and unlabelled theorems, and references with clever-reference
+# modifiers, braces, bad labels and type-only prefixes.  The metadata
+# settings (numbering by section, shared counters, clever references and
+# number offsets) are varied between documents.  Each document is then
+# edited at random (blocks are deleted, copied, swapped and inserted, and
+# sections are added), and after each edit the incremental output and
+# warnings (at xnos-warning-level 2) are compared with those of a full run
+# of TheoremProcessor.  The exit status is 1 if anything differs.
+
+# pylint: disable=invalid-name
+
+import sys
+import copy
+import json
+import random
+import argparse
+
+from benchmark import PANDOCVERSION, API_VERSION, TYPES, _str, _cite
+from benchmark import _meta_str
+
+# pylint: disable=wrong-import-order
+from pandoc_theoremnos import TheoremProcessor, IncrementalProcessor
+from pandoc_theoremnos import _CapturedStderr
+
+# Metadata settings that are varied between documents
+SETTINGS = [('theoremnos-number-by-section', {'t': 'MetaBool', 'c': True}),
+            ('theoremnos-shared-counter', {'t': 'MetaBool', 'c': True}),
+            ('theoremnos-cleveref', {'t': 'MetaBool', 'c': True}),
+            ('xnos-number-offset', {'t': 'MetaString', 'c': '2'})]
+
+
+# Document generation --------------------------------------------------------
+
+_SPACE = {'t': 'Space'}
+
+def _header(level, text, classes=()):
+    """Returns a Header element."""
+    return {'t': 'Header', 'c': [level, ['', list(classes), []],
+                                 [_str(text)]]}
+
+def _theorem(rand, label, labels):
+    """Returns a definition list item for the theorem `label`.  Labels of
+    nested theorems are added to `labels`."""
+    kvs = [['tag', 'A.%d' % len(labels)]] if rand.random() < 0.1 else []
+    title = [_str('Title')] if rand.random() < 0.5 else []
+    content = [{'t': 'Para', 'c': [_str('Body')]}]
+    if rand.random() < 0.1:  # A nested theorem
+        inner = '%s:n%d' % (rand.choice(TYPES[:3])[0], len(labels))
+        labels.append(inner)
+        term = [{'t': 'Span', 'c': [[inner, [], []], []]}]
+        content.append({'t': 'DefinitionList',
+                        'c': [[term, [[{'t': 'Para', 'c': [_str('x')]}]]]]})
+    return [[{'t': 'Span', 'c': [[label, [], kvs], title]}], [content]]
+
+def _reference(rand, labels):
+    """Returns the inlines for a reference to one of `labels`."""
+    label = rand.choice(labels) if labels else 'thm:none'
+    x = rand.random()
+    if x < 0.15:
+        return [_str('+'), _cite(label)]
+    if x < 0.25:
+        return [_str('*'), _cite(label)]
+    if x < 0.35:
+        return [_str('{'), _cite(label), _str('}')]
+    if x < 0.4:
+        return [_str('!'), _cite(label)]
+    if x < 0.45:
+        return [_cite('thm:missing')]
+    if x < 0.5:
+        return [_cite('other:' + label)]
+    if x < 0.55:
+        return [_cite('smith2000')]
+    return [_cite(label)]
+
+def make_document(rand, sections=4):
+    """Returns a random document AST."""
+
+    labels = []
+    blocks = []
+    for i in range(sections):
+        blocks.append(_header(1, 'Section',
+                              ['unnumbered'] if i == 2 else []))
+        for _ in range(rand.randint(2, 5)):
+            items = []
+            for _ in range(rand.randint(1, 4)):
+                thid = rand.choice(TYPES[:3])[0]
+                if rand.random() < 0.1:
+                    label = thid + ':'  # Unlabelled
+                else:
+                    label = '%s:l%d' % (thid, len(labels))
+                    labels.append(label)
+                items.append(_theorem(rand, label, labels))
+            blocks.append({'t': 'DefinitionList', 'c': items})
+            if rand.random() < 0.3:
+                blocks.append(_header(2, 'Subsection'))
+        for _ in range(2):
+            inlines = [_str('See')]
+            for _ in range(rand.randint(1, 4)):
+                inlines.append(_SPACE)
+                inlines.extend(_reference(rand, labels))
+            blocks.append({'t': 'Para', 'c': inlines})
+
+    meta = {'theoremnos-names':
+                {'t': 'MetaList',
+                 'c': [{'t': 'MetaMap',
+                        'c': {'id': _meta_str(thid),
+                              'name': _meta_str(name)}}
+                       for thid, name in TYPES[:4]]},
+            'xnos-warning-level': {'t': 'MetaString', 'c': '2'}}
+    for name, value in SETTINGS:
+        if rand.random() < 0.3:
+            meta[name] = value
+
+    return {'pandoc-api-version': API_VERSION, 'meta': meta,
+            'blocks': blocks}
+
+def edit(rand, blocks, n):
+    """Makes a random edit to `blocks` in place.  `n` numbers the edit."""
+    i = rand.randrange(len(blocks))
+    x = rand.random()
+    if x < 0.25 and len(blocks) > 2:
+        del blocks[i]
+    elif x < 0.5:  # May duplicate labels
+        blocks.insert(i, copy.deepcopy(rand.choice(blocks)))
+    elif x < 0.65:
+        blocks.insert(i, _header(1, 'New'))
+    elif x < 0.8:
+        j = rand.randrange(len(blocks))
+        blocks[i], blocks[j] = blocks[j], blocks[i]
+    else:
+        blocks.insert(i, {'t': 'Para', 'c': [_str('edit%d' % n)]})
+
+
+# Main program ---------------------------------------------------------------
+
+def main():
+    """Runs the check."""
+
+    parser = argparse.ArgumentParser(\
+      description='Checks that IncrementalProcessor gives the same output '
+      'and warnings as full runs over random edits of random documents.')
+    parser.add_argument('--documents', type=int, default=20,
+                        help='Number of documents (default 20).')
+    parser.add_argument('--edits', type=int, default=15,
+                        help='Edits per document (default 15).')
+    parser.add_argument('--formats', type=lambda s: s.split(','),
+                        default=['html', 'latex', 'docx'],
+                        help='Output formats (default html,latex,docx).')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed (default 0).')
+    args = parser.parse_args()
+
+    full = TheoremProcessor()
+    checked = failed = 0
+    for k in range(args.documents):
+        for fmt in args.formats:
+            rand = random.Random('%d-%d-%s' % (args.seed, k, fmt))
+            doc = make_document(rand)
+            incremental = IncrementalProcessor()
+            for n in range(args.edits + 1):
+                if n:
+                    edit(rand, doc['blocks'], n)
+                with _CapturedStderr() as want_stderr:
+                    want = json.dumps(full.process_document(
+                        copy.deepcopy(doc), fmt, PANDOCVERSION))
+                with _CapturedStderr() as got_stderr:
+                    got = json.dumps(incremental.process_document(
+                        copy.deepcopy(doc), fmt, PANDOCVERSION))
+                checked += 1
+                if got_stderr.getvalue() != want_stderr.getvalue():
+                    got = None
+                if got != want:
+                    failed += 1
+                    sys.stderr.write('Mismatch: document %d, %s, edit %d\n' %
+                                     (k, fmt, n))
+
+    sys.stderr.write('%d of %d runs differ\n' % (failed, checked))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
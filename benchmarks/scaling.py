@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+
+"""scaling.py: checks how pandoc-theoremnos scales with theorem runs."""
+
+
+# Copyright 2015-2019 Thomas J. Duck and Johannes Schlatow
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# OVERVIEW
+#
+# The first pass is timed on documents holding a single definition list of
+# N consecutive theorems, with N doubling from --start to --stop.  The
+# growth exponent k in time ~ N^k is estimated by a least-squares fit of
+# log(time) against log(N).  Linear growth gives k close to 1.  The
+# results are written as JSON, and the exit status is 1 if k exceeds
+# --max-exponent.
+
+# pylint: disable=invalid-name
+
+import sys
+import json
+import math
+import argparse
+
+from pandocfilters import walk
+
+from benchmark import PANDOCVERSION, clock, make_document
+
+# pylint: disable=wrong-import-order
+from pandoc_theoremnos import TheoremProcessor
+
+
+def time_first_pass(doc, fmt, repeat):
+    """Returns the minimum time taken by the first pass over `doc`."""
+    times = []
+    text = json.dumps(doc)
+    for _ in range(repeat):
+        doc = json.loads(text)
+        processor = TheoremProcessor()
+        processor.init_pandocxnos(PANDOCVERSION, doc)
+        processor.process(doc['meta'])
+        start = clock()
+        walk(doc['blocks'], processor.process_theorems, fmt, doc['meta'])
+        times.append(clock() - start)
+    return min(times)
+
+def exponent(sizes, times):
+    """Returns the slope of the least-squares fit of log(times) against
+    log(sizes)."""
+    x = [math.log(n) for n in sizes]
+    y = [math.log(t) for t in times]
+    xm, ym = sum(x)/len(x), sum(y)/len(y)
+    return sum((a-xm)*(b-ym) for a, b in zip(x, y)) / \
+      sum((a-xm)**2 for a in x)
+
+def main():
+    """Runs the scaling benchmark."""
+
+    parser = argparse.ArgumentParser(\
+      description='Checks that the first pass scales linearly with the '
+      'number of consecutive theorems.')
+    parser.add_argument('--start', type=int, default=1000,
+                        help='Smallest number of theorems (default 1000).')
+    parser.add_argument('--stop', type=int, default=16000,
+                        help='Largest number of theorems (default 16000).')
+    parser.add_argument('--formats', type=lambda s: s.split(','),
+                        default=['html', 'latex'],
+                        help='Output formats (default html,latex).')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per size (default 3).')
+    parser.add_argument('--max-exponent', type=float, default=1.3,
+                        help='Largest acceptable growth exponent '
+                        '(default 1.3).')
+    args = parser.parse_args()
+
+    sizes = []
+    n = args.start
+    while n <= args.stop:
+        sizes.append(n)
+        n *= 2
+
+    results = []
+    for fmt in args.formats:
+        times = [time_first_pass(make_document(n, 4, 0, 0, 0, run=n), fmt,
+                                 args.repeat)
+                 for n in sizes]
+        k = exponent(sizes, times)
+        results.append({'format': fmt, 'sizes': sizes, 'times': times,
+                        'exponent': k})
+        sys.stderr.write('%s: exponent %.2f\n' % (fmt, k))
+
+    json.dump({'results': results}, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+    if max(result['exponent'] for result in results) > args.max_exponent:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+
+"""startup.py: times the start-up of pandoc-theoremnos."""
+
+
+# Copyright 2015-2019 Thomas J. Duck and Johannes Schlatow
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# OVERVIEW
+#
+# For small documents, most of the time taken by the filter is spent
+# starting python and importing modules.  This benchmark times fresh
+# python processes filtering a small document without any theorems (as
+# pandoc would call the filter for each chapter of a book):
+#
+#   python      - a bare `python -c pass`, for reference
+#   filter_main - the pandoc-theoremnos command (the front end in
+#                 pandoc_theoremnos_client, which passes the document
+#                 through without importing pandoc_theoremnos)
+#   main        - pandoc_theoremnos.main(), which imports everything
+#
+# The minimum and median of the timings (in seconds) are written as JSON.
+
+# pylint: disable=invalid-name
+
+import os
+import sys
+import json
+import platform
+import argparse
+import subprocess
+
+from benchmark import clock, make_document, _summarize
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# The commands that are timed
+COMMANDS = [
+    ('python', 'pass'),
+    ('filter_main',
+     'import pandoc_theoremnos_client; '
+     'pandoc_theoremnos_client.filter_main()'),
+    ('main', 'import pandoc_theoremnos; pandoc_theoremnos.main()')]
+
+
+def time_command(code, fmt, data):
+    """Returns the time taken by a fresh python process to run `code`
+    with the arguments [`fmt`] and `data` as stdin."""
+    env = dict(os.environ, THEOREMNOS_CACHE='0')
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+    start = clock()
+    proc = subprocess.Popen([sys.executable, '-c', code, fmt],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            env=env)
+    proc.communicate(data)
+    t = clock() - start
+    if proc.returncode:
+        raise RuntimeError('Command failed: %s' % code)
+    return t
+
+def main():
+    """Runs the start-up benchmark."""
+
+    parser = argparse.ArgumentParser(\
+      description='Times the start-up of pandoc-theoremnos for a small '
+      'document without any theorems.')
+    parser.add_argument('--formats', type=lambda s: s.split(','),
+                        default=['html'],
+                        help='Output formats (default html).')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Runs per command (default 20).')
+    args = parser.parse_args()
+
+    doc = make_document(0, 4, 0, 0, 0)
+    doc['blocks'] = [{'t': 'Para', 'c': [{'t': 'Str', 'c': 'Text.'}]}]
+    data = json.dumps(doc).encode('utf-8')
+
+    results = []
+    for fmt in args.formats:
+        for name, code in COMMANDS:
+            time_command(code, fmt, data)  # Warm the file system cache
+            times = [time_command(code, fmt, data)
+                     for _ in range(args.repeat)]
+            result = {'command': name, 'format': fmt}
+            result.update(_summarize(times))
+            results.append(result)
+            sys.stderr.write('%s %s: %.4fs\n' % (fmt, name, result['min']))
+
+    report = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'repeat': args.repeat,
+              'results': results}
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
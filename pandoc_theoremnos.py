@@ -29,7 +29,7 @@ __version__ = '2.0.0a3'
 #   1. Insert text for the theorem number in each theorem.
 #      For LaTeX, change to a numbered theorem and use \label{...}
 #      instead.  The theorem labels and associated theorem numbers
-#      are stored in the global targets tracker.
+#      are stored in the targets tracker of the TheoremProcessor.
 #
 #   2. Replace each reference with an theorem number.  For LaTeX,
 #      replace with \ref{...} instead.
@@ -37,17 +37,23 @@ __version__ = '2.0.0a3'
 # This is followed by injecting header code as needed for certain output
 # formats.
 
-# pylint: disable=invalid-name
+# pylint: disable=invalid-name, import-outside-toplevel
 
+# Modules needed only by some commands or options are imported where they
+# are used.  This keeps the start-up time of the filter down.
+
+import os
+import sys
+import io
 import re
 import functools
 import argparse
 import json
-import textwrap
-import uuid
+import time
 
 from pandocfilters import walk
-from pandocfilters import Div, Plain, RawBlock, Math, Str, Span, DefinitionList
+from pandocfilters import Div, Para, Plain, RawBlock, Math, Str, Space, Span
+from pandocfilters import Strong, DefinitionList
 from pandocfilters import stringify
 
 import pandocxnos
@@ -56,362 +62,1992 @@ from pandocxnos import STRTYPES, STDIN, STDOUT, STDERR
 from pandocxnos import check_bool, get_meta
 from pandocxnos import repair_refs, process_refs_factory, replace_refs_factory
 from pandocxnos import attach_attrs_factory
-from pandocxnos import insert_secnos_factory, delete_secnos_factory
 
+from pandoc_theoremnos_client import socket_path, read_message, write_message
+from pandoc_theoremnos_client import is_passthrough, METANAMES
+
+
+# TeX blocks -----------------------------------------------------------------
+
+# Section number offset
+SECOFFSET_TEX = r"""
+%% pandoc-theoremnos: section number offset
+\setcounter{section}{%s}
+"""
 
-# Patterns for matching labels and references
-LABEL_PATTERN = None
 
-# Meta variables; may be reset elsewhere
-cleveref = False    # Flags that clever references should be used
-capitalise = False  # Flags that plusname should be capitalised
-names = {}          # Stores names and types of theorems
-warninglevel = 2        # 0 - no warnings; 1 - some warnings; 2 - all warnings
-numbersections = False  # Flags that theorems should be numbered by section
-secoffset = 0
-sharedcounter = False
+# Factories ------------------------------------------------------------------
+
+def replace_typed_refs_factory(refs, thids, names, cleveref):
+    """Returns replace_refs(key, value, fmt, meta) action that replaces
+    references to theorems of every type in `thids`.  The name inserted
+    in front of each reference is selected using its label's type.  `refs`
+    maps theorem types to dicts of targets, and `names` maps theorem types
+    to names.  `cleveref` flags that clever references are the default."""
+
+    # Prepare a replace_refs action for each theorem type
+    replacers = {}
+    for thid in thids:
+        replacers[thid] = replace_refs_factory(refs[thid], cleveref, False,
+                                               [names[thid]], [names[thid]])
+
+    def replace_refs(key, value, fmt, meta):
+        """Replaces references with format-specific content."""
+        if key == 'Cite' and len(value) == 3:  # A processed reference
+            thid = value[-2][0]['citationId'].split(':')[0]
+            if thid in replacers:
+                return replacers[thid](key, value, fmt, meta)
+        return None
+
+    return replace_refs
+
+
+# JSON backends --------------------------------------------------------------
+
+# Decoders that may be used in place of json.loads(), in order of preference
+JSON_BACKENDS = ('orjson', 'ujson', 'json')
+
+def get_json_loads(backend=None):
+    """Returns the loads() function of the JSON decoding `backend`.
+
+    `backend` is one of the JSON_BACKENDS or 'auto'; if None, it is taken
+    from the THEOREMNOS_JSON environment variable (default 'auto').  For
+    'auto', the first installed backend is used.  A backend that is not
+    installed falls back to the json module.
+
+    Only decoding is delegated.  The fast encoders do not format numbers
+    and escape characters the same way as json.dumps(), and so their
+    output would not be byte-for-byte identical.
+    """
+    backend = backend or os.environ.get('THEOREMNOS_JSON') or 'auto'
+    if backend != 'auto' and backend not in JSON_BACKENDS:
+        raise ValueError('Unknown JSON backend: %s' % backend)
+    import importlib
+    for name in JSON_BACKENDS if backend == 'auto' else (backend,):
+        try:
+            return importlib.import_module(name).loads
+        except ImportError:
+            if backend != 'auto':
+                STDERR.write('\npandoc-theoremnos: JSON backend %s is not '
+                             'installed; using json\n' % backend)
+    return json.loads
+
+
+# Streaming ------------------------------------------------------------------
+
+def _getenv_bool(name):
+    """Returns True if the environment variable `name` is set to a true
+    value; False otherwise."""
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes', 'on')
+
+# Minimum number of characters read from the input stream at a time
+STREAM_CHUNKSIZE = 65536
+
+class StreamReader(object):
+    """Incrementally decodes JSON from a text stream.  Only as much of the
+    stream is buffered as is needed to decode the next value."""
+
+    def __init__(self, stream):
+        """Initializes the reader."""
+        self.stream = stream
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Reads more text into the buffer.  Returns False at end of file."""
+        if self.eof:
+            return False
+        # Discard the decoded text.  Reading at least as much again as is
+        # already buffered keeps repeated decoding attempts linear.
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        chunk = self.stream.read(max(STREAM_CHUNKSIZE, len(self.buf)))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    def peek(self):
+        """Returns the next non-whitespace character, or '' at the end of
+        the stream."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        """Consumes and returns the next non-whitespace character, which
+        must be one of `chars`."""
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('Expected one of %s in JSON input; found %s' % \
+                             (repr(chars), repr(c) if c else 'end of file'))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decodes and returns the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self._fill():
+                    continue
+                raise
+            # A number at the end of the buffer may have been cut short
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return obj
+
+    def items(self):
+        """Yields (key, value) pairs for the members of the next JSON object.
+        The elements of the 'blocks' array are yielded one at a time as
+        ('block', value) pairs, followed by ('blocks', None)."""
+        self.expect('{')
+        while self.peek() != '}':
+            key = self.value()
+            self.expect(':')
+            if key == 'blocks':
+                self.expect('[')
+                while self.peek() != ']':
+                    yield 'block', self.value()
+                    if self.peek() == ',':
+                        self.expect(',')
+                self.expect(']')
+                yield 'blocks', None
+            else:
+                yield key, self.value()
+            if self.peek() == ',':
+                self.expect(',')
+        self.expect('}')
+
+
+# Target index ---------------------------------------------------------------
+
+try:
+    _intern = sys.intern
+except AttributeError:  # Python 2
+    def _intern(s):
+        """Interns `s` if it is a byte string; unicode can't be interned."""
+        # pylint: disable=undefined-variable
+        return intern(s) if isinstance(s, str) else s
+
+class TargetIndex(dict):
+    """Maps target labels to pandocxnos.Target records.
+
+    The targets are also grouped by theorem type as they are added, so
+    that the map for each type (in `types`) is ready when the references
+    are replaced.  The theorem types are interned.  Targets are never
+    removed.
+    """
+
+    __slots__ = ('types',)
+
+    def __init__(self, targets=()):
+        """Initializes the index with the (label, target) pairs or dict
+        `targets`."""
+        dict.__init__(self)
+        self.types = {}  # Maps theorem types to dicts of their targets
+        self.update(targets)
+
+    def __setitem__(self, label, target):
+        dict.__setitem__(self, label, target)
+        thid = _intern(label.partition(':')[0])
+        if thid not in self.types:
+            self.types[thid] = {}
+        self.types[thid][label] = target
+
+    def __reduce__(self):
+        """Pickles the index as a dict; the groups are rebuilt."""
+        return TargetIndex, (dict(self),)
+
+    def update(self, targets=()):
+        """Adds the (label, target) pairs or dict `targets`."""
+        if isinstance(targets, dict):
+            targets = targets.items()
+        for label, target in targets:
+            self[label] = target
+
+
+# Label index ----------------------------------------------------------------
+
+# Books may be built chapter-by-chapter, with each chapter in its own
+# document.  A label index shared by the chapters records the theorems in
+# each one so that numbering continues from one chapter to the next, and
+# so that references between chapters can be resolved.  The index is a
+# JSON file like
+#
+#   {"version": 1,
+#    "chapters": {"2": {"sections": 3, "last": 2,
+#                       "counters": {"thm": 4, "shared": 1, ...},
+#                       "targets": {"thm:foo": [3, 7, "thm"], ...}}}}
+#
+# The chapters are keyed by number.  "sections" gives the number of
+# numbered level-1 sections in the chapter, "last" gives the section
+# (counted from the start of the chapter) of the last theorem, and
+# "counters" gives the theorem counters after it.  The targets map labels
+# to the theorem number (or tag), section number and type.
+
+INDEX_VERSION = 1
+
+_replace = getattr(os, 'replace', os.rename)  # Python 2 has no os.replace
+
+def load_index(path):
+    """Loads the label index from `path`.  Returns an empty index if the
+    file does not exist."""
+    if not os.path.exists(path):
+        return {'version': INDEX_VERSION, 'chapters': {}}
+    with io.open(path, 'rb') as f:
+        index = json.loads(f.read().decode('utf-8'))
+    if index.get('version') != INDEX_VERSION:
+        raise RuntimeError('Unsupported label index version in %s' % path)
+    return index
+
+def update_index(path, chapter, entry):
+    """Sets the `entry` for `chapter` in the label index at `path`.  The
+    index is locked while it is updated so that chapters may be processed
+    in parallel.  The file is only rewritten if the entry changed.
+    Returns True if the file was rewritten."""
+    try:
+        import fcntl
+    except ImportError:  # Windows
+        fcntl = None
+    lockfile = io.open(path + '.lock', 'ab')
+    try:
+        if fcntl:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        index = load_index(path)
+        if index['chapters'].get(str(chapter)) == entry:
+            return False
+        index['chapters'][str(chapter)] = entry
+        # Readers must never see a partly-written index, so write a
+        # temporary file and move it into place
+        tmppath = '%s.%d.tmp' % (path, os.getpid())
+        with io.open(tmppath, 'wb') as f:
+            f.write(json.dumps(index, indent=1,
+                               sort_keys=True).encode('utf-8'))
+        _replace(tmppath, path)
+        return True
+    finally:
+        lockfile.close()  # Releases the lock
+
+def index_start(index, chapter):
+    """Returns (secno, cursec, counters) at the start of `chapter`, as
+    carried over from the preceding chapters in the label `index`."""
+    secno, cursec, counters = 0, None, {}
+    for key in sorted(index['chapters'], key=int):
+        if int(key) >= chapter:
+            break
+        entry = index['chapters'][key]
+        if entry['last'] is not None:
+            cursec = secno + entry['last']
+            counters = entry['counters']
+        secno += entry['sections']
+    return secno, cursec, counters
+
+
+# Profiling ------------------------------------------------------------------
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+class Profiler(object):
+    """Collects timings and counts for the walks and other steps taken
+    while filtering a document.
+
+    For each walk, the time, the number of elements visited and the number
+    of elements replaced by the action are recorded.  Repeated walks with
+    the same action (e.g., block-by-block when streaming) are accumulated.
+    The peak resident set size of the process is reported where the
+    resource module is available.  Python's allocations may also be traced
+    with tracemalloc, but this slows everything down (unevenly), and so
+    the timings are then not representative.
+    """
+
+    def __init__(self, memory=False):
+        """Initializes the profiler.  Memory tracing is started if
+        `memory` is True."""
+        self.steps = []  # Dicts giving the name, time and counts of steps
+        self.info = {}   # Other information about the document
+        self.tracing = False
+        if memory:
+            try:
+                import tracemalloc
+            except ImportError:  # Python 2
+                pass
+            else:
+                self.tracing = not tracemalloc.is_tracing()
+                if self.tracing:
+                    tracemalloc.start()
+        self.start = _clock()
+
+    def _step(self, name):
+        """Returns the record for step `name`, creating it if needed."""
+        for step in self.steps:
+            if step['name'] == name:
+                return step
+        step = {'name': name, 'time': 0.}
+        self.steps.append(step)
+        return step
+
+    def add(self, name, seconds):
+        """Adds `seconds` to the time taken by step `name`."""
+        self._step(name)['time'] += seconds
+
+    def walk(self, x, action, fmt, meta):
+        """Walks `x` with `action`, recording the time and counts."""
+        step = self._step(action.__name__)
+        step.setdefault('visited', 0)
+        step.setdefault('replaced', 0)
+
+        def counted(key, value, fmt, meta):
+            """Calls the action and counts the visit."""
+            step['visited'] += 1
+            ret = action(key, value, fmt, meta)
+            if ret is not None:
+                step['replaced'] += 1
+            return ret
+
+        start = _clock()
+        ret = walk(x, counted, fmt, meta)
+        step['time'] += _clock() - start
+        return ret
 
-# Processing state variables
-cursec = None  # Current section
-Ntargets = {}  # Number of targets in current section (or document)
-targets = {}   # Maps targets labels to [number/tag, theorem secno]
+    def report(self):
+        """Stops memory tracing and returns the report dict."""
+        report = {'version': __version__, 'steps': self.steps,
+                  'time': _clock() - self.start}
+        report.update(self.info)
+        report['references'] = sum(step['replaced'] for step in self.steps
+                                   if step['name'] == 'replace_refs')
+        try:
+            import resource
+        except ImportError:  # Windows
+            pass
+        else:
+            # ru_maxrss is in kilobytes, except on macOS
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            report['peak_rss'] = rss if sys.platform == 'darwin' else rss*1024
+        if self.tracing:
+            import tracemalloc
+            report['peak_memory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.tracing = False
+        return report
+
+    def write(self, path):
+        """Writes the report to `path`.  If `path` is a directory then a
+        uniquely-named file is written to it."""
+        if os.path.isdir(path):
+            path = os.path.join(path, 'pandoc-theoremnos-%d-%d.json' % \
+                                (int(time.time()*1000), os.getpid()))
+        with io.open(path, 'wb') as f:
+            f.write(json.dumps(self.report(), indent=1,
+                               sort_keys=True).encode('utf-8'))
+
+
+# Theorem processor ----------------------------------------------------------
+
+# pylint: disable=too-many-instance-attributes
+class TheoremProcessor(object):
+    """Numbers theorems and resolves references to them.
+
+    All of the settings and processing state are held by the instance.
+    process_document() resets the state, and so a single processor may be
+    used to filter many documents, one after the other.  Note that
+    pandocxnos keeps some state of its own, and so documents should not be
+    filtered concurrently by threads in the same process.
+    """
+
+    def __init__(self, profiler=None, jobs=1):
+        """Initializes the processor.  Walks are recorded by the Profiler
+        `profiler`, if one is given.  The reference passes over large
+        documents are shared among `jobs` processes (None for one per cpu);
+        see refs_pass()."""
+        self.profiler = profiler
+        self.jobs = jobs
+        self.reset()
+
+    def reset(self):
+        """Resets the settings and processing state."""
+
+        # Patterns for matching labels and references
+        self.LABEL_PATTERN = None
+
+        # Meta variables; may be reset elsewhere
+        self.cleveref = False    # Flags that clever references should be used
+        self.capitalise = False  # Flags that plusname should be capitalised
+        self.names = {}          # Stores names and types of theorems
+        self.warninglevel = 2    # 0 - no; 1 - some; 2 - all warnings
+        self.numbersections = False  # Flags numbering by section
+        self.secoffset = 0
+        self.sharedcounter = False
+        self.unlabelledids = 'sequence'  # How unlabelled thms are identified
+
+        # Processing state variables
+        self.secno = 0      # Number of the section being scanned
+        self.cursec = None  # Section of the last theorem processed
+        self.Ntargets = {}  # Number of targets in current section (or doc)
+        self.targets = TargetIndex()  # Maps target labels to Targets
+        self.unreferenceable = set()  # Labels made up for unlabelled thms
+        self.nunlabelled = 0     # Number of unlabelled theorems
+        self.cited = set()       # Citation ids found in the first pass
+        self.attachable = False  # Flags elements that attach_attrs alters
+
+        # Label index for books built chapter-by-chapter
+        self.indexpath = None  # Path to the label index
+        self.chapter = None    # The chapter number
+        self.secstart = 0      # Section number at the start of the chapter
+        self.foreign = {}      # Maps labels in other chapters to targets
+
+        self.PANDOCVERSION = None
+
+    def init_pandocxnos(self, pandocversion, doc):
+        """Initializes (or re-initializes) pandocxnos for a new document."""
+        self.PANDOCVERSION = pandocxnos.init(pandocversion, doc)
+        pandocxnos.set_warning_level(self.warninglevel)
+        del pandocxnos.badlabels[:]  # Warn about bad labels in every doc
+
+    @staticmethod
+    def _set_cleveref_flag(flag):
+        """Sets the pandocxnos flag that the cleveref package is needed.
+        The flag is set as a side effect of processing references, and so
+        must be carried over when references are processed elsewhere."""
+        # pylint: disable=protected-access
+        pandocxnos.core._cleveref_flag = flag
+
+    def _walk(self, x, action, fmt, meta):
+        """Walks `x` with `action`, recording it if profiling."""
+        if self.profiler:
+            return self.profiler.walk(x, action, fmt, meta)
+        return walk(x, action, fmt, meta)
+
+    # pylint: disable=too-many-branches
+    def _process_theorem(self, attrs, fmt):
+        """Processes the theorem with the parsed attributes `attrs`.
+        Returns a dict containing theorem properties."""
+
+        # Initialize the return value
+        thm = {'is_unreferenceable': False,
+               'is_tagged': False,
+               'attrs': attrs}
+
+        # Identify unreferenceable theorems
+        if attrs.id[-1] == ':': # Make up a unique description
+            if self.unlabelledids == 'uuid':
+                import uuid
+                attrs.id += str(uuid.uuid4())
+            else:  # Number them; the parentheses can't occur in references
+                self.nunlabelled += 1
+                attrs.id += '(%d)' % self.nunlabelled
+            thm['is_unreferenceable'] = True
+            self.unreferenceable.add(attrs.id)
+
+        counter = attrs.id.split(':')[0]
+        if self.sharedcounter:
+            counter = 'shared'
+
+        # Update the current section number
+        if self.secno != self.cursec:  # The section number changed
+            self.cursec = self.secno     # Update the section tracker
+            for key in self.Ntargets:
+                self.Ntargets[key] = 1     # Resets the target counter
+
+        # Pandoc's --number-sections supports section numbering latex/pdf,
+        # html, epub, and docx
+        if self.numbersections:
+            # Latex/pdf supports theorems numbers by section natively.  For
+            # the other formats we must hard-code in theorem numbers by
+            # section as tags.
+            if fmt not in ['latex', 'beamer'] and 'tag' not in attrs:
+                attrs['tag'] = str(self.cursec+self.secoffset) + '.' + \
+                  str(self.Ntargets[counter])
+                self.Ntargets[counter] += 1
+
+        # Save reference information
+        thm['is_tagged'] = 'tag' in attrs
+        if thm['is_tagged']:   # ... then save the tag
+            # Remove any surrounding quotes
+            if attrs['tag'][0] == '"' and attrs['tag'][-1] == '"':
+                attrs['tag'] = attrs['tag'].strip('"')
+            elif attrs['tag'][0] == "'" and attrs['tag'][-1] == "'":
+                attrs['tag'] = attrs['tag'].strip("'")
+            self.targets[attrs.id] = \
+              pandocxnos.Target(attrs['tag'], self.cursec,
+                                attrs.id in self.targets)
+        else:
+            self.targets[attrs.id] = \
+              pandocxnos.Target(self.Ntargets[counter], self.cursec,
+                                attrs.id in self.targets)
+            self.Ntargets[counter] += 1  # Increment the reference counter
 
-PANDOCVERSION = None
+        return thm
 
+    # pylint: disable=too-many-locals
+    def _add_markup(self, fmt, thm, value):
+        """Adds markup to the output."""
 
-# Actions --------------------------------------------------------------------
+        attrs = thm['attrs']
+        ret = None
 
-# pylint: disable=too-many-branches
-def _process_theorem(value, fmt):
-    """Processes the theorem.  Returns a dict containing theorem properties."""
+        if fmt in ['latex', 'beamer']:
 
-    # pylint: disable=global-statement
-    global Ntargets  # Global targets counter
-    global cursec    # Current section
-
-    # Initialize the return value
-    thm = {'is_unreferenceable': False,
-           'is_tagged': False}
-
-    # Parse the theorem attributes
-    attrs = thm['attrs'] = PandocAttributes(value[0], 'pandoc')
-
-    # Bail out if the label does not conform to expectations
-    assert LABEL_PATTERN and LABEL_PATTERN.match(attrs.id)
-
-    # Identify unreferenceable theorems
-    if attrs.id[-1] == ':': # Make up a unique description
-        attrs.id += str(uuid.uuid4())
-        thm['is_unreferenceable'] = True
-
-    counter = attrs.id.split(':')[0]
-    if sharedcounter:
-        counter = 'shared'
-
-    # Update the current section number
-    if attrs['secno'] != cursec:  # The section number changed
-        cursec = attrs['secno']   # Update the global section tracker
-        for key, nref in Ntargets.items(): # pylint: disable=unused-variable
-            Ntargets[key] = 1              # Resets the global target counter
-
-    # Pandoc's --number-sections supports section numbering latex/pdf, html,
-    # epub, and docx
-    if numbersections:
-        # Latex/pdf supports theorems numbers by section natively.  For the
-        # other formats we must hard-code in theorem numbers by section as
-        # tags.
-        if fmt in ['html', 'html5', 'epub', 'epub2', 'epub3', 'docx'] and \
-          'tag' not in attrs:
-            attrs['tag'] = str(cursec+secoffset) + '.' + \
-              str(Ntargets[counter])
-            Ntargets[counter] += 1
-
-    # Save reference information
-    thm['is_tagged'] = 'tag' in attrs
-    if thm['is_tagged']:   # ... then save the tag
-        # Remove any surrounding quotes
-        if attrs['tag'][0] == '"' and attrs['tag'][-1] == '"':
-            attrs['tag'] = attrs['tag'].strip('"')
-        elif attrs['tag'][0] == "'" and attrs['tag'][-1] == "'":
-            attrs['tag'] = attrs['tag'].strip("'")
-        targets[attrs.id] = pandocxnos.Target(attrs['tag'], cursec,
-                                              attrs.id in targets)
-    else:
-        targets[attrs.id] = pandocxnos.Target(Ntargets[counter], cursec,
-                                              attrs.id in targets)
-        Ntargets[counter] += 1  # Increment the global reference counter
-
-    return thm
-
-# pylint: disable=too-many-locals
-def _add_markup(fmt, thm, value):
-    """Adds markup to the output."""
-
-    attrs = thm['attrs']
-    ret = None
-
-    if fmt in ['latex', 'beamer']:
-
-        # remark: tagged theorems are not (yet) supported
-
-        # Present theorem as a definition list
-        env = attrs.id.split(':')[0]
-
-        tmp = value[0][0]['c'][1]
-        title = ''
-        if len(tmp) >= 1:
-            title = '[%s]' % stringify(tmp)
-
-        start = RawBlock('tex',
-                         r'\begin{%s}%s%s' % \
-                         (env, title,
-                          '' if thm['is_unreferenceable'] else
-                          r'\label{%s} '%attrs.id))
-        endtags = RawBlock('tex', r'\end{%s}' % env)
-        content = value[1][0]
-        ret = [start]+content+[endtags]
-
-    elif fmt in ('html', 'html5', 'epub', 'epub2', 'epub3'):
-        if isinstance(targets[attrs.id].num, int):  # Numbered reference
-            num = Str(' %d'%targets[attrs.id].num)
-        else:  # Tagged reference
-            assert isinstance(targets[attrs.id].num, STRTYPES)
-            text = ' ' + targets[attrs.id].num
-            if text.startswith('$') and text.endswith('$'):
-                math = text.replace(' ', r'\ ')[1:-1]
-                num = Math({"t":"InlineMath", "c":[]}, math)
-            else:  # Text
-                num = Str(text)
-
-        # Present theorem as a definition list
-        outer = RawBlock('html',
-                         '<dl%sclass="theoremnos">' % \
-                         (' ' if thm['is_unreferenceable'] else
-                          ' id="%s" '%attrs.id))
-        name = names[attrs.id.split(':')[0]]
-        head = RawBlock('html', '<dt>')
-        endhead = RawBlock('html', '</dt><dd>')
-        title = value[0][0]['c'][1]
-        if len(title) >= 1:
-            title.insert(0, Str(' ('))
-            title.insert(0, num)
-            title.append(Str(')'))
-        else:
-            title.append(num)
-
-        title.insert(0, Str('%s' % name))
-        title.append(Str(':'))
-        content = value[1][0]
-        endtags = RawBlock('html', '</dd></dl>')
-        ret = [outer, head, Plain(title), endhead] + content + [endtags]
-
-    # To do: define default behaviour
-
-    return ret
-
-def _is_theorem(item):
-    """Returns True if item is a theorem; false otherwise."""
-    if item[0][0]['t'] != 'Span':
-        return False
-    attrs = PandocAttributes(item[0][0]['c'][0], 'pandoc')
-    return bool(LABEL_PATTERN.match(attrs.id)) if LABEL_PATTERN else False
-
-def process_theorems(key, value, fmt, meta):  # pylint: disable=unused-argument
-    """Processes the attributed definition lists."""
-
-    # Process definition lists and add markup
-    if key == 'DefinitionList':
-
-        # Split items into groups of regular and numbered items
-        itemgroups = []
-        tmp = []
-        cond = True
-        for v in value:
-            if _is_theorem(v) == cond:
-                tmp.append(v)
+            # remark: tagged theorems are not (yet) supported
+
+            # Present theorem as a definition list
+            env = attrs.id.split(':')[0]
+
+            tmp = value[0][0]['c'][1]
+            title = ''
+            if len(tmp) >= 1:
+                title = '[%s]' % stringify(tmp)
+
+            start = RawBlock('tex',
+                             r'\begin{%s}%s%s' % \
+                             (env, title,
+                              '' if thm['is_unreferenceable'] else
+                              r'\label{%s} '%attrs.id))
+            ret = [start]
+            ret.extend(value[1][0])  # The content
+            ret.append(RawBlock('tex', r'\end{%s}' % env))
+
+        elif fmt in ('html', 'html5', 'epub', 'epub2', 'epub3'):
+            num = self._number(attrs, ' ')
+
+            # Present theorem as a definition list
+            outer = RawBlock('html',
+                             '<dl%sclass="theoremnos">' % \
+                             (' ' if thm['is_unreferenceable'] else
+                              ' id="%s" '%attrs.id))
+            name = self.names[attrs.id.split(':')[0]]
+            head = RawBlock('html', '<dt>')
+            endhead = RawBlock('html', '</dt><dd>')
+            title = value[0][0]['c'][1]
+            if len(title) >= 1:
+                title[:0] = [Str('%s' % name), num, Str(' (')]
+                title.append(Str(')'))
+            else:
+                title[:0] = [Str('%s' % name), num]
+            title.append(Str(':'))
+            ret = [outer, head, Plain(title), endhead]
+            ret.extend(value[1][0])  # The content
+            ret.append(RawBlock('html', '</dd></dl>'))
+
+        else:  # Docx, odt, markdown, plain text and the rest
+
+            # Present theorem as a div with the name, number and title run
+            # into the first paragraph (as amsthm does for LaTeX)
+            name = self.names[attrs.id.split(':')[0]]
+            head = [Strong([Str(name), Space(), self._number(attrs)])]
+            title = value[0][0]['c'][1]
+            if title:
+                head.extend([Space(), Str('(')])
+                head.extend(title)
+                head.append(Str(')'))
+            head.extend([Str(':'), Space()])
+
+            content = value[1][0]
+            if content and content[0]['t'] in ('Para', 'Plain'):
+                content[0]['c'][:0] = head
             else:
-                cond = not cond
-                if tmp:
-                    itemgroups.append(tmp)
-                    tmp = [v]
-        if tmp:
-            itemgroups.append(tmp)
-
-        # Process each group of items
-        ret = []
-        for items in itemgroups:
-            if _is_theorem(items[0]):  # These are numbered items
-                markup = []
-                for item in items:  # Iterate entries
-                    thm = _process_theorem(item[0][0]['c'], fmt)
-                    markup = markup + _add_markup(fmt, thm, item)
-                ret.append(Div(['', ['theoremnos'], []], markup))
-            else:  # These are regular (unnumbered) items
-                ret.append(DefinitionList(items))
+                head.pop()  # The Space
+                content.insert(0, Para(head))
+            ret = [Div(['' if thm['is_unreferenceable'] else attrs.id,
+                        ['theorem'], []], content)]
+
         return ret
 
-    return None
+    def _number(self, attrs, prefix=''):
+        """Returns the element giving the number (or tag) of the theorem
+        with attributes `attrs`, preceded by `prefix`."""
+        target = self.targets[attrs.id]
+        if isinstance(target.num, int):  # Numbered reference
+            return Str('%s%d' % (prefix, target.num))
+        # Tagged reference
+        assert isinstance(target.num, STRTYPES)
+        text = prefix + target.num
+        if text.startswith('$') and text.endswith('$'):
+            math = text.replace(' ', r'\ ')[1:-1]
+            return Math({"t":"InlineMath", "c":[]}, math)
+        return Str(text)  # Text
+
+    def _theorem_attrs(self, item):
+        """Returns the parsed attributes if the definition list `item` is a
+        theorem; None otherwise.  Items are classified using the prefix of
+        the label, and so only the attributes of theorems are parsed."""
+        span = item[0][0]
+        if span['t'] != 'Span':
+            return None
+        prefix, sep, _ = span['c'][0][0].partition(':')
+        if not sep or prefix not in self.names:
+            return None
+        return PandocAttributes(span['c'][0], 'pandoc')
+
+    # pylint: disable=unused-argument
+    def process_theorems(self, key, value, fmt, meta):
+        """Processes the attributed definition lists.  Section numbers are
+        tracked along the way so that only a single walk is required.
+        Citations are also noted so that the second pass may be skipped
+        when no theorems are referenced."""
+
+        # Track the section number
+        if key == 'Header':
+            if value[0] == 1 and 'unnumbered' not in value[1][1]:
+                self.secno += 1
+            return None
+
+        # Note the citations
+        if key == 'Cite':
+            for citation in value[-2]:
+                self.cited.add(citation['citationId'])
+            return None
+
+        # Note any elements that the attach_attrs_span action would alter:
+        # spans followed by an attributes string, and lone images
+        if key in ('Para', 'Plain') and not self.attachable:
+            if len(value) == 1 and value[0]['t'] == 'Image':
+                self.attachable = value[0]['c'][-1][1] != 'fig:'
+            else:
+                for i in range(len(value)-1):
+                    if value[i]['t'] == 'Span' and \
+                      value[i+1]['t'] == 'Str' and \
+                      value[i+1]['c'].startswith('{'):
+                        self.attachable = True
+                        break
+            return None
+
+        # Process definition lists and add markup
+        if key == 'DefinitionList':
+
+            # Classify the items, keeping the attributes of the theorems
+            classified = [(item, self._theorem_attrs(item)) for item in value]
+
+            # Split items into groups of regular and numbered items
+            itemgroups = []
+            tmp = []
+            cond = True
+            for v in classified:
+                if (v[1] is not None) == cond:
+                    tmp.append(v)
+                else:
+                    cond = not cond
+                    if tmp:
+                        itemgroups.append(tmp)
+                        tmp = [v]
+            if tmp:
+                itemgroups.append(tmp)
+
+            # Process each group of items
+            ret = []
+            for items in itemgroups:
+                if items[0][1] is not None:  # These are numbered items
+                    markup = []
+                    for item, attrs in items:  # Iterate entries
+                        thm = self._process_theorem(attrs, fmt)
+                        markup.extend(self._add_markup(fmt, thm, item))
+                    ret.append(Div(['', ['theoremnos'], []], markup))
+                else:  # These are regular (unnumbered) items
+                    ret.append(DefinitionList([item for item, _ in items]))
+            return ret
+
+        return None
+
+    # pylint: disable=too-many-statements
+    def process(self, meta):
+        """Saves metadata fields in the processor's settings."""
+
+        # Read in the metadata fields and do some checking
+
+        for name in ['theoremnos-warning-level', 'xnos-warning-level']:
+            if name in meta:
+                self.warninglevel = int(get_meta(meta, name))
+                pandocxnos.set_warning_level(self.warninglevel)
+                break
+
+        if self.warninglevel:
+            for name in meta:
+                if (name.startswith('theoremnos') or \
+                    name.startswith('xnos')) and name not in METANAMES:
+                    import textwrap
+                    msg = textwrap.dedent("""
+                              pandoc-theoremnos: unknown meta variable "%s"\n
+                          """ % name)
+                    STDERR.write(msg)
+
+        for name in ['theoremnos-cleveref', 'xnos-cleveref']:
+            # 'xnos-cleveref' enables cleveref in all 3 of
+            # fignos/eqnos/tablenos
+            if name in meta:
+                self.cleveref = check_bool(get_meta(meta, name))
+                break
+
+        for name in ['xnos-capitalise', 'xnos-capitalize']:
+            # 'xnos-capitalise' enables capitalise in all 4 of
+            # fignos/eqnos/tablenos/theoremonos.  Since this uses an option
+            # in the caption package, it is not possible to select between
+            # the four.
+            # 'xnos-capitalize' is an alternative spelling
+            if name in meta:
+                self.capitalise = check_bool(get_meta(meta, name))
+                break
+
+        for name in ['theoremnos-number-by-section', 'xnos-number-by-section']:
+            if name in meta:
+                self.numbersections = check_bool(get_meta(meta, name))
+                break
+
+        if 'xnos-number-offset' in meta:
+            self.secoffset = int(get_meta(meta, 'xnos-number-offset'))
+
+        if 'theoremnos-shared-counter' in meta:
+            self.sharedcounter = \
+              check_bool(get_meta(meta, 'theoremnos-shared-counter'))
+
+        if 'theoremnos-names' in meta:
+            assert meta['theoremnos-names']['t'] == 'MetaList'
+            for entry in get_meta(meta, 'theoremnos-names'):
+                assert isinstance(entry, dict), "%s is of type %s" % \
+                  (entry, type(entry))
+                assert 'id' in entry and isinstance(entry['id'], STRTYPES)
+                assert 'name' in entry and isinstance(entry['name'], STRTYPES)
+                self.names[entry['id']] = entry['name']
+                self.Ntargets[entry['id']] = 0
+
+            self.Ntargets['shared'] = 0
+
+        if 'theoremnos-unlabelled-ids' in meta:
+            self.unlabelledids = get_meta(meta, 'theoremnos-unlabelled-ids')
+            if self.unlabelledids not in ('sequence', 'uuid'):
+                raise RuntimeError('theoremnos-unlabelled-ids must be '
+                                   '"sequence" or "uuid"')
+
+        if 'theoremnos-index' in meta:
+            self.indexpath = get_meta(meta, 'theoremnos-index')
+            if 'theoremnos-chapter' not in meta:
+                raise RuntimeError('theoremnos-index requires that '
+                                   'theoremnos-chapter is also set')
+            self.chapter = int(get_meta(meta, 'theoremnos-chapter'))
+
+        if self.names:
+            self.LABEL_PATTERN = \
+              re.compile("(%s):%s" % ('|'.join(self.names.keys()), r'[\w/-]*'))
+
+
+    def add_tex(self, meta):
+        """Adds tex to the meta data."""
+
+        warnings = self.warninglevel == 2 and self.targets and \
+          (pandocxnos.cleveref_required() or len(self.names) or \
+           self.secoffset or self.numbersections)
+        if warnings:
+            import textwrap
+            msg = textwrap.dedent("""\
+                      pandoc-theoremnos: Wrote the following blocks to
+                      header-includes.  If you use pandoc's
+                      --include-in-header option then you will need to
+                      manually include these yourself.
+                  """)
+            STDERR.write('\n')
+            STDERR.write(textwrap.fill(msg))
+            STDERR.write('\n')
 
+        # Update the header-includes metadata.  Pandoc's
+        # --include-in-header option will override anything we do here.  This
+        # is a known issue and is owing to a design decision in pandoc.
+        # See https://github.com/jgm/pandoc/issues/3139.
+
+        if pandocxnos.cleveref_required() and self.targets:
+            tex = """
+                %%%% pandoc-theoremnos: required package
+                \\usepackage{amsthm}
+                \\usepackage%s{cleveref}
+            """ % ('[capitalise]' if self.capitalise else '')
+            pandocxnos.add_to_header_includes(
+                meta, 'tex', tex,
+                regex=r'\\usepackage(\[[\w\s,]*\])?\{cleveref\}')
+
+        if self.secoffset and self.targets:
+            pandocxnos.add_to_header_includes(
+                meta, 'tex', SECOFFSET_TEX % self.secoffset,
+                            regex=r'\\setcounter\{section\}')
+
+        if self.names:
+            tex = """
+                %% pandoc-theoremnos: set theorem types
+                """
+            firstid = None
+            for thid, thname in self.names.items():
+                tex += """\\newtheorem{%s}%s{%s}%s
+                """ % (thid, '[%s]' % firstid if firstid is not None else '',
+                       thname, '[section]' if self.numbersections and \
+                       firstid is None \
+                       else '')
+
+                if self.sharedcounter and firstid is None:
+                    firstid = thid
+
+            pandocxnos.add_to_header_includes(meta, 'tex', tex)
+
+        if warnings:
+            STDERR.write('\n')
 
-# TeX blocks -----------------------------------------------------------------
+    def load_index(self):
+        """Continues the numbering from the chapters preceding this one in
+        the label index, and collects the targets in other chapters."""
+
+        if not self.indexpath:
+            return
+
+        index = load_index(self.indexpath)
+
+        # Pick up where the preceding chapter left off
+        self.secno, self.cursec, counters = index_start(index, self.chapter)
+        self.secstart = self.secno
+        for key in self.Ntargets:
+            if key in counters:
+                self.Ntargets[key] = counters[key]
+
+        for key, entry in index['chapters'].items():
+            if int(key) != self.chapter:
+                for label, (num, secno, _) in entry['targets'].items():
+                    self.foreign[label] = pandocxnos.Target(num, secno, False)
+
+    def save_index(self):
+        """Saves this chapter's theorems to the label index."""
+
+        if not self.indexpath:
+            return
+
+        entry = {
+            'sections': self.secno - self.secstart,
+            'last': self.cursec - self.secstart if self.targets else None,
+            'counters': dict(self.Ntargets),
+            'targets': dict((label, [target.num, target.secno,
+                                     label.split(':')[0]])
+                            for label, target in self.targets.items()
+                            if label not in self.unreferenceable)}
+
+        update_index(self.indexpath, self.chapter, entry)
+
+    def refs_actions(self, fmt):
+        """Returns the list of actions for the second (reference) pass.
+        Actions that would have nothing to do, given what was found in the
+        first pass, are left out so that their walks are skipped."""
+
+        # References may also be made to theorems in other chapters
+        targets = self.targets
+        if self.foreign:
+            targets = TargetIndex(self.foreign)
+            targets.update(self.targets)
+
+        # Get the theorem types that are cited.  Pandoc < 1.18 may break
+        # references into other elements, and so their types can't be
+        # known until the references are repaired.
+        legacy = self.PANDOCVERSION < '1.18'
+        citedtypes = set()
+        for label in self.cited:
+            match = self.LABEL_PATTERN.match(label)
+            if match:
+                citedtypes.add(match.group(1))
 
-# Section number offset
-SECOFFSET_TEX = r"""
-%% pandoc-theoremnos: section number offset
-\setcounter{section}{%s}
-"""
+        if fmt in ('latex', 'beamer'):
+            process_refs = process_refs_factory(self.LABEL_PATTERN,
+                                                targets.keys())
 
+            # Latex takes care of inserting the correct plusname/starname
+            replace_refs = replace_refs_factory(targets,
+                                                self.cleveref, False,
+                                                ['UNUSED'],
+                                                ['UNUSED'])
 
-# Main program ---------------------------------------------------------------
+            process_all_refs = [process_refs, replace_refs] \
+              if citedtypes or legacy else []
+        else:
+            # Replace all theorem types in a single pass (the correct name
+            # for each reference is selected using the label's type)
+            process_all_refs = []
+
+            refs = targets.types
+            thids = [thid for thid in self.names if thid in refs and \
+                     (thid in citedtypes or legacy)]
+            if thids:
+                PATTERN = re.compile("(%s):%s" % ('|'.join(thids),
+                                                  r'[\w/-]*'))
+                process_refs = process_refs_factory(PATTERN, targets.keys())
+                replace_refs = replace_typed_refs_factory(refs, thids,
+                                                          self.names,
+                                                          self.cleveref)
+
+                process_all_refs.append(process_refs)
+                process_all_refs.append(replace_refs)
 
-# pylint: disable=too-many-statements
-def process(meta):
-    """Saves metadata fields in global variables and returns a few
-    computed fields."""
+        attach_attrs_span = attach_attrs_factory('pandoc-theoremnos', Span,
+                                                 replace=True)
 
+        actions = process_all_refs
+        if legacy:
+            actions = [repair_refs] + actions
+        if actions or self.attachable:
+            actions = actions + [attach_attrs_span]
+        return actions
+
+    def refs_pass(self, blocks, fmt, meta):
+        """Applies the second (reference) pass to the list of `blocks`.
+        Returns the altered blocks.
+
+        The pass is local to each block once the targets are known.  If
+        `jobs` is not 1 and there are at least PARALLEL_MIN_BLOCKS blocks,
+        then the blocks are divided into contiguous shards that are
+        processed by a pool of worker processes.  Otherwise the blocks are
+        processed here.
+        """
+
+        actions = self.refs_actions(fmt)
+        if not actions:
+            return blocks
+
+        jobs = self.jobs
+        if jobs is None:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        if jobs > 1 and len(blocks) >= PARALLEL_MIN_BLOCKS:
+            return _parallel_refs_pass(self, blocks, fmt, meta, jobs)
+
+        return functools.reduce(
+            lambda x, action: self._walk(x, action, fmt, meta),
+            actions, blocks)
+
+    # pylint: disable=too-many-branches
+    def filter_stream(self, reader, fmt, pandocversion, stdout):
+        """Filters the document read by the StreamReader `reader`, writing the
+        results to `stdout`.
+
+        Theorems are numbered as the blocks are decoded.  References can
+        only be resolved once all of the theorems are known, and so the
+        second pass is applied block-by-block as the output is written.  The
+        raw input and output texts are never held in memory as a whole.
+
+        The blocks are written before the metadata so that changes made by
+        add_tex() can be included.  Otherwise the output is the same as for
+        json.dump().
+        """
+
+        self.reset()
+
+        blocks = []   # Blocks processed by the first pass
+        pending = []  # Blocks read before the metadata
+        fields = []   # (key, value) pairs for the other top-level fields
+        meta = None
+
+        # Read the document
+        for key, value in reader.items():
+            if key == 'block':
+                if meta is None:
+                    pending.append(value)
+                elif self.LABEL_PATTERN:  # First pass
+                    blocks.extend(self._walk([value], self.process_theorems,
+                                             fmt, meta))
+                else:
+                    blocks.append(value)
+            elif key == 'blocks':
+                fields.append((key, None))
+            else:
+                fields.append((key, value))
+                if key == 'meta':
+                    meta = value
+                    self.process(meta)
+                    self.load_index()
+                    if self.LABEL_PATTERN:
+                        pending = self._walk(pending, self.process_theorems,
+                                             fmt, meta)
+                    blocks.extend(pending)
+                    pending = []
+        if meta is None:
+            blocks = pending
+
+        # Initialize pandocxnos
+        self.init_pandocxnos(pandocversion, dict(fields))
+
+        # Prepare the second pass
+        actions = self.refs_actions(fmt) if self.LABEL_PATTERN else []
+
+        # Write the blocks
+        stdout.write('{"blocks": [')
+        blocks.reverse()  # Pop blocks from the end to free them as we go
+        sep = ''
+        while blocks:
+            altered = functools.reduce(
+                lambda x, action: self._walk(x, action, fmt, meta),
+                actions, [blocks.pop()])
+            for block in altered:
+                stdout.write(sep)
+                stdout.write(json.dumps(block))
+                sep = ', '
+        stdout.write(']')
+
+        if self.LABEL_PATTERN:
+            if fmt in ['latex', 'beamer']:
+                self.add_tex(meta)
+            self.save_index()
+
+        # Write the remaining fields, with the metadata last
+        fields.sort(key=lambda field: field[0] == 'meta')
+        for key, value in fields:
+            if key != 'blocks':
+                stdout.write(', %s: %s' % (json.dumps(key), json.dumps(value)))
+        stdout.write('}')
+
+    def process_document(self, doc, fmt, pandocversion=None):
+        """Filters the pandoc document AST `doc` for the output format
+        `fmt`.  Returns the filtered document."""
+
+        self.reset()
+
+        # Initialize pandocxnos
+        self.init_pandocxnos(pandocversion, doc)
+
+        # Chop up the doc
+        meta = doc['meta'] if self.PANDOCVERSION >= '1.18' \
+          else doc[0]['unMeta']
+        blocks = doc['blocks'] if self.PANDOCVERSION >= '1.18' else doc[1:]
+
+        # Process the metadata variables
+        self.process(meta)
+        self.load_index()
+
+        if self.LABEL_PATTERN:
+            # First pass
+            altered = self._walk(blocks, self.process_theorems, fmt, meta)
+
+            # Second pass
+            altered = self.refs_pass(altered, fmt, meta)
+
+            if fmt in ['latex', 'beamer']:
+                self.add_tex(meta)
+
+            # Update the doc
+            if self.PANDOCVERSION >= '1.18':
+                doc['blocks'] = altered
+            else:
+                doc = doc[:1] + altered
+
+            self.save_index()
+
+        return doc
+
+
+# Parallel reference passes --------------------------------------------------
+
+# The fewest top-level blocks for which the reference passes are shared among
+# processes.  Starting the workers and passing the blocks to and fro costs
+# more than is saved for smaller documents.
+PARALLEL_MIN_BLOCKS = 5000
+
+# State for worker processes; set by _init_refs_worker()
+_refs_actions = None  # The second-pass actions
+_refs_fmt = None      # The output format
+_refs_meta = None     # The document metadata
+_refs_blocks = None   # The document blocks, where inherited from the parent
+
+class _Messages(list):
+    """Collects the messages that pandocxnos writes to stderr.  Each is
+    stored with the label it warns about if it is a bad reference warning,
+    or None otherwise."""
+
+    def __init__(self):
+        list.__init__(self)
+        self.nbadlabels = len(pandocxnos.badlabels)
+
+    def write(self, msg):
+        """Stores the message `msg`."""
+        # pandocxnos notes each bad label just before warning about it
+        n = len(pandocxnos.badlabels)
+        label = pandocxnos.badlabels[-1] if n > self.nbadlabels else None
+        self.nbadlabels = n
+        self.append((label, msg))
+
+    def flush(self):
+        """Does nothing."""
+
+def _write_messages(messages, badlabels):
+    """Writes the `messages` collected by a _Messages to stderr.  Bad
+    labels already in the list `badlabels` are not warned about again;
+    the others are added to it."""
+    for label, msg in messages:
+        if label is not None:
+            if label in badlabels:
+                continue
+            badlabels.append(label)
+        STDERR.write(msg)
+        STDERR.flush()
+
+def _init_refs_worker(state, fmt, meta, blocks):
+    """Initializes a worker process for _parallel_refs_pass().  `state`
+    holds the attributes of the parent's TheoremProcessor."""
     # pylint: disable=global-statement
-    global cleveref    # Flags that clever references should be used
-    global capitalise  # Flags that plusname should be capitalised
-    global names       # Sets theorem types and names
-    global warninglevel    # 0 - no warnings; 1 - some; 2 - all
-    global LABEL_PATTERN
-    global numbersections
-    global secoffset
-    global sharedcounter
-
-    # Read in the metadata fields and do some checking
-
-    for name in ['theoremnos-warning-level', 'xnos-warning-level']:
-        if name in meta:
-            warninglevel = int(get_meta(meta, name))
-            pandocxnos.set_warning_level(warninglevel)
-            break
+    global _refs_actions
+    global _refs_fmt
+    global _refs_meta
+    global _refs_blocks
+    processor = TheoremProcessor()
+    processor.__dict__.update(state)
+    processor.init_pandocxnos(processor.PANDOCVERSION, None)
+    _refs_actions = processor.refs_actions(fmt)
+    _refs_fmt = fmt
+    _refs_meta = meta
+    _refs_blocks = blocks
+
+def _refs_shard(shard):
+    """Applies the reference pass to a shard of the blocks.  `shard` is
+    either a (start, stop) slice of the inherited blocks, or a list of
+    blocks.  Returns the altered blocks, the pandocxnos cleveref flag and
+    the messages written."""
+    if _refs_blocks is not None:
+        shard = _refs_blocks[shard[0]:shard[1]]
+    messages = _Messages()
+    pandocxnos.core.STDERR = messages
+    try:
+        shard = functools.reduce(
+            lambda x, action: walk(x, action, _refs_fmt, _refs_meta),
+            _refs_actions, shard)
+    finally:
+        pandocxnos.core.STDERR = STDERR
+    return shard, pandocxnos.cleveref_required(), messages
+
+def _parallel_refs_pass(processor, blocks, fmt, meta, jobs):
+    """Applies the reference pass of `processor` to `blocks` using a pool
+    of `jobs` worker processes.  Returns the altered blocks.
+
+    The frozen targets and settings are given to each worker when it
+    starts.  Where processes are forked the workers inherit the blocks,
+    and only the altered blocks are passed back.  Otherwise the shards
+    are passed to the workers as well.  Warnings are written in document
+    order, and bad references are warned about once, as for one process.
+    """
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    start = _clock()
+
+    # Divide the blocks into a few shards per worker to balance the load
+    n = jobs*4
+    bounds = [len(blocks)*i//n for i in range(n+1)]
+    shards = list(zip(bounds[:-1], bounds[1:]))
+
+    state = dict(vars(processor), profiler=None)
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        initargs = (state, fmt, meta, blocks)
+    else:
+        context = multiprocessing.get_context()
+        initargs = (state, fmt, meta, None)
+        shards = [blocks[i:j] for i, j in shards]
+
+    altered = []
+    cleveref = False
+    executor = ProcessPoolExecutor(jobs, mp_context=context,
+                                   initializer=_init_refs_worker,
+                                   initargs=initargs)
+    with executor:
+        for shard, flag, messages in executor.map(_refs_shard, shards):
+            altered.extend(shard)
+            cleveref = cleveref or flag
+            _write_messages(messages, pandocxnos.badlabels)
+
+    # Clever references found by the workers require the cleveref package
+    if cleveref:
+        processor._set_cleveref_flag(True)  # pylint: disable=protected-access
+
+    if processor.profiler:
+        processor.profiler.add('parallel_refs_pass', _clock() - start)
+    return altered
+
+
+# Incremental processing -----------------------------------------------------
+
+def _digest(obj):
+    """Returns a digest of the JSON-serializable `obj`."""
+    import hashlib
+    return hashlib.sha1(json.dumps(obj).encode('utf-8')).hexdigest()
+
+class IncrementalProcessor(TheoremProcessor):
+    """Filters successive versions of a document (e.g., as it is edited),
+    reusing the work done for the previous version.
+
+    A record is kept for each top-level block: a hash of the input, the
+    theorem counters before and after it, the targets it defines, the
+    labels it cites, its output from each pass and the warnings given in
+    the second pass.  The first pass is only repeated for blocks that
+    changed or that start with different counters (i.e., those after a
+    change in the same counter scope).  The
+    second pass is only repeated for blocks whose first-pass output changed
+    or that cite targets that changed.  The output is the same as for
+    TheoremProcessor.process_document().
+
+    Everything is processed afresh when the metadata, output format or
+    pandoc version changes.  Documents from pandoc < 1.18 and documents
+    using a label index are always processed in full.
+
+    Blocks in the returned documents are shared with the records, and so
+    must not be modified.
+    """
+
+    def __init__(self, profiler=None):
+        """Initializes the processor."""
+        self.previous = None  # The records for the previous document
+        self._defined = []    # (label, target) pairs defined by a block
+        self._unlabelled = []  # Labels made up for a block's theorems
+        TheoremProcessor.__init__(self, profiler)
+
+    def _process_theorem(self, attrs, fmt):
+        """Processes the theorem, noting the target it defines."""
+        thm = TheoremProcessor._process_theorem(self, attrs, fmt)
+        self._defined.append((attrs.id, self.targets[attrs.id]))
+        if thm['is_unreferenceable']:
+            self._unlabelled.append(attrs.id)
+        return thm
+
+    def _counters(self):
+        """Returns the state of the theorem counters."""
+        return (self.secno, self.cursec, sorted(self.Ntargets.items()),
+                self.nunlabelled)
+
+    def _is_reusable(self, record, counters):
+        """Returns True if the first-pass `record` for a block still holds
+        given the current `counters` and targets."""
+        if record is None or record['before'] != counters:
+            return False
+        seen = set()
+        for label, target in record['targets']:
+            if (label in self.targets or label in seen) != \
+              target.has_duplicate:
+                return False
+            seen.add(label)
+        return True
+
+    # pylint: disable=too-many-locals
+    def process_document(self, doc, fmt, pandocversion=None):
+        """Filters the pandoc document AST `doc` for the output format
+        `fmt`.  Returns the filtered document."""
+
+        self._defined, self._unlabelled = [], []
+
+        if not isinstance(doc, dict) or 'theoremnos-index' in doc['meta']:
+            self.previous = None
+            return TheoremProcessor.process_document(self, doc, fmt,
+                                                     pandocversion)
+
+        self.reset()
+        self.init_pandocxnos(pandocversion, doc)
+
+        # Start afresh if anything besides the blocks changed
+        settings = _digest([fmt, self.PANDOCVERSION,
+                            [(key, doc[key]) for key in sorted(doc)
+                             if key != 'blocks']])
+        previous = self.previous
+        if previous is None or previous['settings'] != settings:
+            previous = {'records': [], 'targets': {}, 'signature': None}
+
+        meta, blocks = doc['meta'], doc['blocks']
+        self.process(meta)
+        if not self.LABEL_PATTERN:
+            self.previous = None
+            return doc
+
+        # Align the blocks with the previous records using the unchanged
+        # blocks at the start and end of the document
+        hashes = [_digest(block) for block in blocks]
+        old = previous['records']
+        n, m = len(hashes), len(old)
+        start = 0
+        while start < min(n, m) and hashes[start] == old[start]['hash']:
+            start += 1
+        end = 0
+        while end < min(n, m) - start and \
+          hashes[n-end-1] == old[m-end-1]['hash']:
+            end += 1
+        aligned = old[:start] + [None]*(n-start-end) + old[m-end:]
 
-    metanames = ['theoremnos-warning-level', 'xnos-warning-level',
-                 'theoremnos-cleveref', 'xnos-cleveref',
-                 'xnos-capitalise', 'xnos-capitalize',
-                 'xnos-caption-separator', # Used by pandoc-fignos/tablenos
-                 'theoremnos-names',
-                 'xnos-number-by-section',
-                 'theoremnos-shared-counter',
-                 'theoremnos-number-by-section',
-                 'xnos-number-offset']
-
-    if warninglevel:
-        for name in meta:
-            if (name.startswith('theoremnos') or name.startswith('xnos')) and \
-              name not in metanames:
-                msg = textwrap.dedent("""
-                          pandoc-theoremnos: unknown meta variable "%s"\n
-                      """ % name)
-                STDERR.write(msg)
-
-    for name in ['theoremnos-cleveref', 'xnos-cleveref']:
-        # 'xnos-cleveref' enables cleveref in all 3 of fignos/eqnos/tablenos
-        if name in meta:
-            cleveref = check_bool(get_meta(meta, name))
-            break
+        # First pass
+        records = []
+        cited = set()
+        attachable = False
+        for block, digest, record in zip(blocks, hashes, aligned):
+            counters = self._counters()
+            if self._is_reusable(record, counters):
+                for label, target in record['targets']:
+                    self.targets[label] = target
+                self.unreferenceable.update(record['unreferenceable'])
+                self.secno, self.cursec, Ntargets, self.nunlabelled = \
+                  record['after']
+                self.Ntargets = dict(Ntargets)
+                record = dict(record, fresh=None)
+            else:
+                self.cited, self.attachable = set(), False
+                self._defined, self._unlabelled = [], []
+                altered = self._walk([block], self.process_theorems,
+                                     fmt, meta)
+                record = {'hash': digest, 'before': counters,
+                          'after': self._counters(),
+                          'targets': self._defined,
+                          'unreferenceable': self._unlabelled,
+                          'cited': self.cited, 'attachable': self.attachable,
+                          'first': json.dumps(altered), 'fresh': altered,
+                          'output': None, 'messages': None}
+            cited |= record['cited']
+            attachable = attachable or record['attachable']
+            records.append(record)
+        self.cited, self.attachable = cited, attachable
+
+        # Second pass.  The actions change as a whole if the theorem types
+        # cited or defined change.
+        actions = self.refs_actions(fmt)
+        signature = ([action.__name__ for action in actions],
+                     sorted(set(label.split(':')[0] for label in cited)),
+                     sorted(set(label.split(':')[0]
+                                for label in self.targets)))
+        rerun = signature != previous['signature']
+        altered = []
+        for record, prior in zip(records, aligned):
+            fresh = record.pop('fresh')
+            if fresh is None and not rerun and not any(
+                    previous['targets'].get(label) != self.targets.get(label)
+                    for label in record['cited'] | set(
+                        label.split(':')[-1] for label in record['cited'])):
+                record['output'] = prior['output']
+                if record['cleveref']:
+                    self._set_cleveref_flag(True)
+            else:
+                if fresh is None:
+                    fresh = json.loads(record['first'])
+                flag = pandocxnos.cleveref_required()
+                self._set_cleveref_flag(None)
+                # The block's messages from each action are kept so that
+                # they can be repeated when it is reused
+                del pandocxnos.badlabels[:]
+                record['messages'] = []
+                try:
+                    for action in actions:
+                        record['messages'].append(_Messages())
+                        pandocxnos.core.STDERR = record['messages'][-1]
+                        fresh = self._walk(fresh, action, fmt, meta)
+                finally:
+                    pandocxnos.core.STDERR = STDERR
+                record['output'] = fresh
+                record['cleveref'] = bool(pandocxnos.cleveref_required())
+                self._set_cleveref_flag(flag or record['cleveref'] or None)
+            altered.extend(record['output'])
+
+        # Each action is applied to the whole document in a full run, and so
+        # the messages are written action-by-action
+        badlabels = []  # Bad labels warned about so far
+        for i in range(len(actions)):
+            for record in records:
+                _write_messages(record['messages'][i], badlabels)
+        pandocxnos.badlabels[:] = badlabels
 
-    for name in ['xnos-capitalise', 'xnos-capitalize']:
-        # 'xnos-capitalise' enables capitalise in all 4 of
-        # fignos/eqnos/tablenos/theoremonos.  Since this uses an option in
-        # the caption package, it is not possible to select between the four.
-        # 'xnos-capitalize' is an alternative spelling
-        if name in meta:
-            capitalise = check_bool(get_meta(meta, name))
-            break
+        if fmt in ['latex', 'beamer']:
+            self.add_tex(meta)
+
+        doc['blocks'] = altered
+
+        self.previous = {'settings': settings, 'records': records,
+                         'targets': dict(self.targets),
+                         'signature': signature}
+
+        return doc
+
+
+# Captured messages ----------------------------------------------------------
+
+class _CapturedStderr(object):
+    """Captures the messages written to stderr by pandoc-theoremnos and
+    pandocxnos within a `with` block.  getvalue() returns the text.  If
+    `echo` is True then the text is also written to stderr at the end of
+    the block."""
+
+    def __init__(self, echo=False):
+        self.buffer = io.StringIO()
+        self.echo = echo
+        self.saved = None
+
+    def __enter__(self):
+        global STDERR  # pylint: disable=global-statement
+        self.saved = STDERR, pandocxnos.core.STDERR
+        STDERR = pandocxnos.core.STDERR = self.buffer
+        return self
+
+    def __exit__(self, *args):
+        global STDERR  # pylint: disable=global-statement
+        STDERR, pandocxnos.core.STDERR = self.saved
+        if self.echo and self.getvalue():
+            STDERR.write(self.getvalue())
+            STDERR.flush()
+
+    def getvalue(self):
+        """Returns the captured text."""
+        return self.buffer.getvalue()
+
+
+# Result cache ---------------------------------------------------------------
+
+class ResultCache(object):
+    """An on-disk cache of filtered documents.
+
+    Entries are keyed on a hash of the input document, the output format,
+    the pandoc version and the versions of the filter and pandoc-xnos.
+    The messages written while filtering are stored alongside the output
+    so that they can be repeated.  The total size of the entries is
+    bounded by `maxsize` bytes.  Entries are touched when they are used,
+    and the least recently used entries are evicted first (the limit may
+    be overshot slightly between checks).  Caching is best-effort: errors
+    reading or writing the cache are ignored.
+    """
+
+    EVICT_CHECKS = 16  # Eviction checks per size limit stored
+
+    def __init__(self, path, maxsize):
+        """Initializes the cache in directory `path`."""
+        self.path = path
+        self.maxsize = maxsize
+
+    @staticmethod
+    def key(text, fmt, pandocversion):
+        """Returns the key for the input document `text`."""
+        import hashlib
+        h = hashlib.sha256()
+        for part in (__version__, pandocxnos.core.__version__, fmt,
+                     pandocversion or ''):
+            h.update(part.encode('utf-8') + b'\0')
+        h.update(text if isinstance(text, bytes) else text.encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        """Returns the cached (output, messages) for `key`, or None."""
+        path = os.path.join(self.path, key + '.json')
+        try:
+            with io.open(path, 'rb') as f:
+                text = f.read().decode('utf-8')
+            os.utime(path, None)  # Mark it as recently used
+        except (IOError, OSError):
+            return None
+        try:
+            with io.open(os.path.join(self.path, key + '.err'), 'rb') as f:
+                messages = f.read().decode('utf-8')
+        except (IOError, OSError):  # There were no messages
+            messages = ''
+        return text, messages
+
+    def _write(self, path, text):
+        """Writes `text` to `path` so that readers never see part of it."""
+        tmppath = '%s.%d.tmp' % (path, os.getpid())
+        with io.open(tmppath, 'wb') as f:
+            f.write(text.encode('utf-8'))
+        _replace(tmppath, path)
+
+    def put(self, key, text, messages=''):
+        """Stores the output `text` and the `messages` for `key`."""
+        path = os.path.join(self.path, key + '.json')
+        errpath = os.path.join(self.path, key + '.err')
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            # The messages are stored first so that they are there
+            # whenever the output is
+            if messages:
+                self._write(errpath, messages)
+            elif os.path.exists(errpath):
+                os.remove(errpath)
+            self._write(path, text)
+            if self._is_eviction_due(len(text)):
+                self.evict()
+        except (IOError, OSError):
+            pass
+
+    def _is_eviction_due(self, size):
+        """Returns True if the cache should be checked for eviction after
+        storing `size` bytes.
+
+        Checking scans the whole cache, and so is only done occasionally:
+        on average once for every 1/EVICT_CHECKS of the size limit that is
+        stored.  The scanning per entry stored is then bounded regardless
+        of the cache size, and the limit is overshot by about this much
+        between checks.  Choosing at random means that no state needs to
+        be shared between processes.
+        """
+        import random
+        return random.random()*self.maxsize < size*self.EVICT_CHECKS
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                path = os.path.join(self.path, name)
+                try:
+                    st = os.stat(path)
+                except OSError:  # Evicted by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.maxsize:
+                break
+            for victim in (path, path[:-5] + '.err'):
+                try:
+                    os.remove(victim)
+                except OSError:
+                    pass
+            total -= size
+
+def get_cache(environ=None):
+    """Returns the ResultCache configured by the `environ` dict (default
+    os.environ), or None if caching is disabled.
+
+    THEOREMNOS_CACHE=0 disables the cache.  THEOREMNOS_CACHE_DIR gives the
+    cache directory (default $XDG_CACHE_HOME/pandoc-theoremnos), and
+    THEOREMNOS_CACHE_SIZE gives its size in megabytes (default 256).
+    """
+    environ = os.environ if environ is None else environ
+    if environ.get('THEOREMNOS_CACHE', '').lower() in \
+      ('0', 'false', 'no', 'off'):
+        return None
+    path = environ.get('THEOREMNOS_CACHE_DIR') or \
+      os.path.join(environ.get('XDG_CACHE_HOME') or \
+                   os.path.join(os.path.expanduser('~'), '.cache'),
+                   'pandoc-theoremnos')
+    maxsize = int(environ.get('THEOREMNOS_CACHE_SIZE', 256))
+    return ResultCache(path, maxsize*1024*1024)
+
+
+# pylint: disable=too-many-arguments
+def filter_text(text, fmt, pandocversion=None, processor=None,
+                loads=json.loads, cache=None):
+    """Filters the pandoc JSON document `text` for the output format `fmt`
+    and returns the filtered JSON text.
+
+    Documents with nothing to filter are returned as is, without being
+    decoded.  Otherwise, if a ResultCache is given then it is checked
+    first, and the tree is only walked on a miss.  The warnings given for
+    a cached document are repeated.  Documents that use a label index are
+    never cached because their output depends on the index.
+    """
+
+    processor = processor or TheoremProcessor()
+
+    if is_passthrough(text, fmt):
+        if processor.profiler:
+            processor.profiler.info['passthrough'] = True
+        return text
+
+    if not cache or 'theoremnos-index' in text:
+        return _process_text(text, fmt, pandocversion, processor, loads)
+
+    key = cache.key(text, fmt,
+                    pandocversion or os.environ.get('PANDOC_VERSION'))
+    cached = cache.get(key)
+    if cached is not None:
+        out, messages = cached
+        if messages:
+            STDERR.write(messages)
+            STDERR.flush()
+        return out
+
+    with _CapturedStderr(echo=True) as captured:
+        out = _process_text(text, fmt, pandocversion, processor, loads)
+    cache.put(key, out, captured.getvalue())
+    return out
+
+def _process_text(text, fmt, pandocversion, processor, loads):
+    """Decodes, processes and encodes the document `text`."""
+
+    profiler = processor.profiler
+
+    start = _clock()
+    doc = loads(text)
+    if profiler:
+        profiler.add('json_load', _clock() - start)
+
+    doc = processor.process_document(doc, fmt, pandocversion)
+
+    # The document is encoded in one go, which lets the json module use its
+    # (much faster) C encoder
+    start = _clock()
+    out = json.dumps(doc)
+    if profiler:
+        profiler.add('json_dump', _clock() - start)
+
+    return out
+
+
+# Server ---------------------------------------------------------------------
+
+def _server_class():
+    """Returns the class of the server and its request handler.  They are
+    defined here so that socketserver is only imported when serving."""
+
+    try:
+        import socketserver
+    except ImportError:  # Python 2
+        import SocketServer as socketserver
+    import traceback
+
+    class FilterRequestHandler(socketserver.StreamRequestHandler):
+        """Filters a document sent by pandoc-theoremnos-client."""
+
+        def handle(self):
+            """Handles the request.  Warnings are passed back to the client
+            rather than written to the server's stderr."""
+            header, data = read_message(self.rfile)
+            with _CapturedStderr() as captured:
+                try:
+                    loads, cache, jobs = self.configure(header)
+                    out = filter_text(data.decode('utf-8'), header['fmt'],
+                                      header.get('pandocversion'),
+                                      TheoremProcessor(jobs=jobs or None),
+                                      loads, cache)
+                except Exception:  # pylint: disable=broad-except
+                    write_message(self.wfile,
+                                  {'status': 'error',
+                                   'message': traceback.format_exc(),
+                                   'stderr': captured.getvalue()})
+                    return
+            write_message(self.wfile, {'status': 'ok',
+                                       'stderr': captured.getvalue()},
+                          out.encode('utf-8'))
+
+        def configure(self, header):
+            """Returns the JSON decoder, ResultCache (or None) and number
+            of jobs for the request.  The client's settings take the place
+            of the server's environment variables of the same names."""
+            if not header.get('settings'):
+                return self.server.loads, self.server.cache, self.server.jobs
+            environ = dict(os.environ)
+            environ.update(header['settings'])
+            return get_json_loads(environ.get('THEOREMNOS_JSON')), \
+              get_cache(environ), int(environ.get('THEOREMNOS_JOBS', 1))
+
+    if hasattr(os, 'fork'):
+        # Each request is handled in a forked child.  Requests can then be
+        # handled concurrently without sharing the pandocxnos state, and the
+        # children inherit the modules already imported by the server.
+        class FilterServer(socketserver.ForkingMixIn,
+                           socketserver.UnixStreamServer):
+            """Serves pandoc-theoremnos-client requests."""
+    else:
+        class FilterServer(socketserver.UnixStreamServer):
+            """Serves pandoc-theoremnos-client requests."""
+
+    return FilterServer, FilterRequestHandler
+
+def _make_private_dir(path):
+    """Creates the directory `path` with mode 0700 if it doesn't exist.
+    Raises RuntimeError if it is not a directory private to this user."""
+    import stat
+    try:
+        os.mkdir(path, 0o700)
+    except OSError:  # It exists (or can't be made; lstat() will tell)
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_mode & 0o077 or \
+      (hasattr(os, 'getuid') and st.st_uid != os.getuid()):
+        raise RuntimeError('%s is not a directory private to this user' %
+                           path)
+
+def serve(path=None):
+    """Serves pandoc-theoremnos-client requests on the unix socket `path`
+    (default socket_path()) until interrupted."""
+
+    import socket
+    import signal
+
+    # The default socket is kept in a directory that only we can use, so
+    # that other users can neither read the documents nor answer for us
+    if not path:
+        path = socket_path()
+        if 'THEOREMNOS_SOCKET' not in os.environ:
+            _make_private_dir(os.path.dirname(path))
+
+    # Remove a stale socket, but don't hijack one that is in use
+    if os.path.exists(path):
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            sock.close()
+        except socket.error:
+            os.unlink(path)
+        else:
+            raise RuntimeError('A server is already listening on %s' % path)
+
+    server_class, handler_class = _server_class()
+    server = server_class(path, handler_class)
+    server.loads = get_json_loads()
+    server.cache = get_cache()
+    server.jobs = int(os.environ.get('THEOREMNOS_JOBS', 1))
+    STDERR.write('pandoc-theoremnos: serving on %s\n' % path)
+    STDERR.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+def serve_main(argv):
+    """Runs the `pandoc-theoremnos serve` command."""
+    parser = argparse.ArgumentParser(
+        prog='pandoc-theoremnos serve',
+        description='Serves pandoc-theoremnos-client filter requests.')
+    parser.add_argument('--socket', help='The unix socket path.')
+    args = parser.parse_args(argv)
+    serve(args.socket)
+
+
+# Batch processing -----------------------------------------------------------
+
+# State for worker processes; set by _init_batch_worker()
+_batch_processor = None  # A TheoremProcessor reused for every document
+_batch_loads = None      # The JSON decoding function
+_batch_cache = None      # The ResultCache, or None
+
+def _init_batch_worker(json_backend=None, use_cache=True):
+    """Initializes a worker process for batch() or an AsyncFilter."""
+    # pylint: disable=global-statement
+    global _batch_processor
+    global _batch_loads
+    global _batch_cache
+    _batch_processor = TheoremProcessor()
+    _batch_loads = get_json_loads(json_backend)
+    _batch_cache = get_cache() if use_cache else None
+
+def _filter_file(job):
+    """Filters a document file.  `job` is a (inpath, outpath, fmt,
+    pandocversion) tuple.  Returns (inpath, outpath, error), where error is
+    None on success."""
+    inpath, outpath, fmt, pandocversion = job
+    import traceback
+    try:
+        with io.open(inpath, 'rb') as f:
+            text = f.read().decode('utf-8')
+        out = filter_text(text, fmt, pandocversion, _batch_processor,
+                          _batch_loads, _batch_cache)
+        with io.open(outpath, 'wb') as f:
+            f.write(out.encode('utf-8'))
+    except Exception:  # pylint: disable=broad-except
+        return inpath, outpath, traceback.format_exc()
+    return inpath, outpath, None
+
+# pylint: disable=too-many-arguments
+def batch(paths, fmt, pandocversion=None, workers=None, json_backend=None,
+          use_cache=True):
+    """Filters many document files using a pool of worker processes.
+
+    `paths` is a list of (inpath, outpath) pairs giving the pandoc JSON
+    files to read and write.  Each file is filtered exactly as it would
+    be by an individual run of the filter.  The pool has `workers`
+    processes (default: the number of cpus); each worker loads the filter
+    once and reuses its TheoremProcessor.  With one worker the files are
+    filtered in this process.  The ResultCache is used unless `use_cache`
+    is False.
+
+    Yields an (inpath, outpath, error) tuple for each file, in order.
+    The error is None on success, and a traceback string otherwise.
+    """
+
+    jobs = [(inpath, outpath, fmt, pandocversion)
+            for inpath, outpath in paths]
+
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(jobs))
+
+    if workers <= 1:
+        _init_batch_worker(json_backend, use_cache)
+        for job in jobs:
+            yield _filter_file(job)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    executor = ProcessPoolExecutor(workers, initializer=_init_batch_worker,
+                                   initargs=(json_backend, use_cache))
+    with executor:
+        chunksize = max(1, len(jobs) // (workers*4))
+        for result in executor.map(_filter_file, jobs, chunksize=chunksize):
+            yield result
+
+def _read_manifest(path):
+    """Reads a batch manifest.  Each line gives an input file path and
+    (optionally) an output file path.  Paths may be quoted; blank lines
+    and lines starting with '#' are ignored.  Returns a list of
+    (inpath, outpath) pairs, where outpath may be None."""
+    import shlex
+    paths = []
+    with io.open(path, encoding='utf-8') as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            fields = shlex.split(line)
+            if len(fields) > 2:
+                raise ValueError('%s:%d: Expected at most 2 paths' % (path, n))
+            paths.append((fields[0], fields[1] if len(fields) == 2 else None))
+    return paths
+
+def batch_main(argv):
+    """Runs the `pandoc-theoremnos batch` command."""
+
+    parser = argparse.ArgumentParser(
+        prog='pandoc-theoremnos batch',
+        description='Filters many pandoc JSON documents in parallel.')
+    parser.add_argument('fmt', help='The output format.')
+    parser.add_argument('files', nargs='*', help='Pandoc JSON files.')
+    parser.add_argument('--manifest',
+                        help='A file listing input (and output) paths.')
+    parser.add_argument('--outdir',
+                        help='The directory for outputs not in the manifest.')
+    parser.add_argument('--jobs', '-j', type=int,
+                        help='The number of worker processes.')
+    parser.add_argument('--pandocversion', help='The pandoc version.')
+    parser.add_argument('--json', choices=('auto',)+JSON_BACKENDS,
+                        help='The JSON decoding backend.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not use the result cache.')
+    args = parser.parse_args(argv)
+
+    paths = [(path, None) for path in args.files]
+    if args.manifest:
+        paths.extend(_read_manifest(args.manifest))
+    if not paths:
+        parser.error('no input files')
+
+    # Outputs not given by the manifest are written to the output directory
+    if any(outpath is None for inpath, outpath in paths):
+        if not args.outdir:
+            parser.error('--outdir is required for inputs without outputs')
+        if not os.path.isdir(args.outdir):
+            os.makedirs(args.outdir)
+        paths = [(inpath, outpath or \
+                  os.path.join(args.outdir, os.path.basename(inpath)))
+                 for inpath, outpath in paths]
+
+    # Inputs with the same file name would overwrite each other's output
+    seen = {}
+    for inpath, outpath in paths:
+        key = os.path.normcase(os.path.abspath(outpath))
+        if key in seen:
+            parser.error('%s and %s would both be written to %s' % \
+                         (seen[key], inpath, outpath))
+        seen[key] = inpath
+
+    # Report the result for each file
+    failed = 0
+    for inpath, outpath, error in batch(paths, args.fmt, args.pandocversion,
+                                        args.jobs, args.json,
+                                        not args.no_cache):
+        if error:
+            failed += 1
+            STDERR.write('\npandoc-theoremnos: failed to filter %s:\n%s' % \
+                         (inpath, error))
+            STDERR.flush()
+        else:
+            STDOUT.write('%s -> %s\n' % (inpath, outpath))
+            STDOUT.flush()
+    if failed:
+        sys.exit(1)
+
+
+# Asyncio --------------------------------------------------------------------
+
+def _filter_doc(job):
+    """Filters a document for an AsyncFilter.  `job` is a (doc, fmt,
+    pandocversion) tuple, where `doc` is the pandoc JSON document as bytes,
+    text or a decoded dict.  Returns the filtered document in the same
+    form."""
+    doc, fmt, pandocversion = job
+    if isinstance(doc, dict):
+        return _batch_processor.process_document(doc, fmt, pandocversion)
+    if isinstance(doc, bytes):
+        return filter_text(doc.decode('utf-8'), fmt, pandocversion,
+                           _batch_processor, _batch_loads,
+                           _batch_cache).encode('utf-8')
+    return filter_text(doc, fmt, pandocversion, _batch_processor,
+                       _batch_loads, _batch_cache)
+
+class AsyncFilter(object):
+    """Filters documents for asyncio applications (python 3 only).
+
+    Documents are filtered by a pool of `workers` processes (default: the
+    number of cpus), so that the event loop is never blocked by the
+    decoding or walks.  The pool size limits how many documents are
+    filtered at once; others wait their turn.  Each worker has its own
+    module state (including that of pandocxnos), and so documents never
+    share it.  The json_backend and use_cache arguments are as for
+    batch().
+
+    Usage:
+
+        thmfilter = AsyncFilter(workers=4)
+        ...
+        doc = await thmfilter.filter(doc, 'html')
+        ...
+        thmfilter.close()
+    """
+
+    def __init__(self, workers=None, json_backend=None, use_cache=True):
+        """Starts the worker pool."""
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        self.executor = ProcessPoolExecutor(
+            workers or multiprocessing.cpu_count(),
+            initializer=_init_batch_worker,
+            initargs=(json_backend, use_cache))
+
+    def filter(self, doc, fmt, pandocversion=None):
+        """Returns an awaitable future for filtering the pandoc JSON document
+        `doc` (bytes, text or a decoded dict) for the output format `fmt`.
+        The result is the filtered document in the same form as `doc`.
+        Must be called from a coroutine running in the event loop."""
+        import asyncio
+        loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+        return loop.run_in_executor(self.executor, _filter_doc,
+                                    (doc, fmt, pandocversion))
+
+    def close(self, wait=True):
+        """Shuts down the worker pool."""
+        self.executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
-    for name in ['theoremnos-number-by-section', 'xnos-number-by-section']:
-        if name in meta:
-            numbersections = check_bool(get_meta(meta, name))
-            break
 
-    if 'xnos-number-offset' in meta:
-        secoffset = int(get_meta(meta, 'xnos-number-offset'))
-
-    if 'theoremnos-shared-counter' in meta:
-        sharedcounter = check_bool(get_meta(meta, 'theoremnos-shared-counter'))
-
-    if 'theoremnos-names' in meta:
-        assert meta['theoremnos-names']['t'] == 'MetaList'
-        for entry in get_meta(meta, 'theoremnos-names'):
-            assert isinstance(entry, dict), "%s is of type %s" % \
-              (entry, type(entry))
-            assert 'id' in entry and isinstance(entry['id'], STRTYPES)
-            assert 'name' in entry and isinstance(entry['name'], STRTYPES)
-            names[entry['id']] = entry['name']
-            Ntargets[entry['id']] = 0
-
-        Ntargets['shared'] = 0
-
-    if names:
-        LABEL_PATTERN = \
-          re.compile("(%s):%s" % ('|'.join(names.keys()), r'[\w/-]*'))
-
-
-def add_tex(meta):
-    """Adds tex to the meta data."""
-
-    warnings = warninglevel == 2 and targets and \
-      (pandocxnos.cleveref_required() or len(names) or secoffset or \
-       numbersections)
-    if warnings:
-        msg = textwrap.dedent("""\
-                  pandoc-theoremnos: Wrote the following blocks to
-                  header-includes.  If you use pandoc's
-                  --include-in-header option then you will need to
-                  manually include these yourself.
-              """)
-        STDERR.write('\n')
-        STDERR.write(textwrap.fill(msg))
-        STDERR.write('\n')
-
-    # Update the header-includes metadata.  Pandoc's
-    # --include-in-header option will override anything we do here.  This
-    # is a known issue and is owing to a design decision in pandoc.
-    # See https://github.com/jgm/pandoc/issues/3139.
-
-    if pandocxnos.cleveref_required() and targets:
-        tex = """
-            %%%% pandoc-theoremnos: required package
-            \\usepackage{amsthm}
-            \\usepackage%s{cleveref}
-        """ % ('[capitalise]' if capitalise else '')
-        pandocxnos.add_to_header_includes(
-            meta, 'tex', tex,
-            regex=r'\\usepackage(\[[\w\s,]*\])?\{cleveref\}')
-
-    if secoffset and targets:
-        pandocxnos.add_to_header_includes(
-            meta, 'tex', SECOFFSET_TEX % secoffset,
-                        regex=r'\\setcounter\{section\}')
-
-    if names:
-        tex = """
-            %% pandoc-theoremnos: set theorem types
-            """
-        firstid = None
-        for thid, thname in names.items():
-            tex += """\\newtheorem{%s}%s{%s}%s
-            """ % (thid, '[%s]' % firstid if firstid is not None else '',
-                   thname, '[section]' if numbersections and firstid is None \
-                   else '')
-
-            if sharedcounter and firstid is None:
-                firstid = thid
-
-        pandocxnos.add_to_header_includes(meta, 'tex', tex)
-
-    if warnings:
-        STDERR.write('\n')
+# Main program ---------------------------------------------------------------
 
+# Commands that may be given in place of the output format
+COMMANDS = {'serve': serve_main, 'batch': batch_main}
 
 # pylint: disable=too-many-locals, unused-argument
 def main(stdin=STDIN, stdout=STDOUT, stderr=STDERR):
     """Filters the document AST."""
 
-    # pylint: disable=global-statement
-    global PANDOCVERSION
+    # Run a command rather than the filter if one is given
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
 
     # Read the command-line arguments
     parser = argparse.ArgumentParser(\
@@ -421,89 +2057,60 @@ def main(stdin=STDIN, stdout=STDOUT, stderr=STDERR):
       version='%(prog)s {version}'.format(version=__version__))
     parser.add_argument('fmt')
     parser.add_argument('--pandocversion', help='The pandoc version.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Read and write the document incrementally.')
+    parser.add_argument('--json', choices=('auto',)+JSON_BACKENDS,
+                        help='The JSON decoding backend.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not use the result cache.')
+    parser.add_argument('--jobs', '-j', type=int,
+                        help='The number of processes for the reference '
+                        'passes over large documents (0 for one per cpu).')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Write a profile of the run to PATH (a file '
+                        'or directory).')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='Trace memory allocations when profiling '
+                        '(slows the run).')
     args = parser.parse_args()
 
-    # Get the output format and document
+    # Get the output format
     fmt = args.fmt
-    doc = json.loads(stdin.read())
 
-    # Initialize pandocxnos
-    PANDOCVERSION = pandocxnos.init(args.pandocversion, doc)
-
-    # Chop up the doc
-    meta = doc['meta'] if PANDOCVERSION >= '1.18' else doc[0]['unMeta']
-    blocks = doc['blocks'] if PANDOCVERSION >= '1.18' else doc[1:]
-
-    # Process the metadata variables
-    process(meta)
-
-    if LABEL_PATTERN:
-        # First pass
-        insert_secnos = insert_secnos_factory(Span)
-        delete_secnos = delete_secnos_factory(Span)
-        altered = functools.reduce(lambda x, action: walk(x, action, fmt, meta),
-                                   [insert_secnos, process_theorems,
-                                    delete_secnos], blocks)
-
-        # Second pass
-        if fmt in ('latex', 'beamer'):
-            process_refs = process_refs_factory(LABEL_PATTERN,
-                                                targets.keys())
-
-            STDERR.write('\n')
-            STDERR.write(str(LABEL_PATTERN))
-            STDERR.write('\n')
-
-            # Latex takes care of inserting the correct plusname/starname
-            replace_refs = replace_refs_factory(targets,
-                                                cleveref, False,
-                                                ['UNUSED'],
-                                                ['UNUSED'])
-            
-            process_all_refs = [process_refs, replace_refs]
+    # Profiles are written to a JSON sidecar file.  The result cache is not
+    # used when profiling so that the filter's work is measured.
+    profile = args.profile or os.environ.get('THEOREMNOS_PROFILE')
+    profiler = Profiler(args.profile_memory or \
+                        _getenv_bool('THEOREMNOS_PROFILE_MEMORY')) \
+      if profile else None
+
+    # The reference passes over large documents may be run in parallel
+    jobs = args.jobs if args.jobs is not None else \
+      int(os.environ.get('THEOREMNOS_JOBS', 1))
+    processor = TheoremProcessor(profiler, jobs or None)
+
+    # Large documents may be filtered incrementally
+    if args.stream or _getenv_bool('THEOREMNOS_STREAM'):
+        reader = StreamReader(stdin)
+        if reader.peek() == '{':  # Streaming requires pandoc >= 1.18
+            processor.filter_stream(reader, fmt, args.pandocversion, stdout)
         else:
-            # Replace each theorem type separately (to insert the correct names)
-            process_all_refs = []
-
-            for thid, thname in names.items():
-                refs = {}
-                for key, value in targets.items():
-                    if key.split(':')[0] == thid:
-                        refs[key] = value
-                if refs:
-
-                    PATTERN = re.compile("%s:%s" % (thid, r'[\w/-]*'))
-                    process_refs = process_refs_factory(PATTERN,
-                                                        refs.keys())
-                    replace_refs = replace_refs_factory(refs,
-                                                        cleveref, False,
-                                                        [thname],
-                                                        [thname])
-
-                    process_all_refs.append(process_refs)
-                    process_all_refs.append(replace_refs)
-
-        attach_attrs_span = attach_attrs_factory('pandoc-theoremnos', Span,
-                                                 replace=True)
-        altered = functools.reduce(lambda x, action: walk(x, action, fmt, meta),
-                                   [repair_refs] + process_all_refs +
-                                   [attach_attrs_span],
-                                   altered)
-
-        if fmt in ['latex', 'beamer']:
-            add_tex(meta)
-
-        # Update the doc
-        if PANDOCVERSION >= '1.18':
-            doc['blocks'] = altered
-        else:
-            doc = doc[:1] + altered
-
-    # Dump the results
-    json.dump(doc, stdout)
+            doc = processor.process_document(reader.value(), fmt,
+                                             args.pandocversion)
+            stdout.write(json.dumps(doc))
+    else:
+        # Filter the document
+        cache = None if args.no_cache or profiler else get_cache()
+        stdout.write(filter_text(stdin.read(), fmt, args.pandocversion,
+                                 processor, get_json_loads(args.json), cache))
 
     # Flush stdout
     stdout.flush()
 
+    if profiler:
+        profiler.info['format'] = fmt
+        profiler.info['theorems'] = len(processor.targets)
+        profiler.write(profile)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,263 @@
+#! /usr/bin/env python
+
+"""pandoc-theoremnos-client: passes documents to a pandoc-theoremnos server."""
+
+
+# Copyright 2015-2019 Thomas J. Duck and Johannes Schlatow
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# OVERVIEW
+#
+# Starting python and importing pandoc-theoremnos and its dependencies
+# can take longer than filtering a small document.  A resident server
+# (started using `pandoc-theoremnos serve`) avoids this cost.  This client
+# is what pandoc calls as a filter.  It imports only what it needs to pass
+# the document to the server and the result back to pandoc.
+#
+# Each request is a one-line JSON header giving the output format, the
+# pandoc version, the client's settings (see SETTINGS) and the length of
+# the document, followed by the UTF-8 encoded document.  The reply is a
+# one-line JSON header giving the status and length, followed by the
+# filtered document.
+#
+# If no server is running then the document is filtered in-process.  So
+# is a document that is to be streamed or profiled.
+#
+# This module also provides the entry point for the pandoc-theoremnos
+# filter itself (filter_main()).  Documents with nothing to filter are
+# detected by scanning the raw text, and are passed straight back to pandoc
+# without loading pandoc-theoremnos and its dependencies.  Modules are
+# imported only where they are needed so that this is fast.
+
+# pylint: disable=invalid-name, import-outside-toplevel
+
+import os
+import sys
+import io
+
+
+# Passthrough ----------------------------------------------------------------
+
+# The meta variables known to pandoc-theoremnos.  Others that start with
+# 'theoremnos' or 'xnos' are warned about.
+METANAMES = ('theoremnos-warning-level', 'xnos-warning-level',
+             'theoremnos-cleveref', 'xnos-cleveref',
+             'xnos-capitalise', 'xnos-capitalize',
+             'xnos-caption-separator', # Used by pandoc-fignos/tablenos
+             'theoremnos-names',
+             'xnos-number-by-section',
+             'theoremnos-shared-counter',
+             'theoremnos-number-by-section',
+             'xnos-number-offset',
+             'theoremnos-index', 'theoremnos-chapter',
+             'theoremnos-unlabelled-ids')
+
+# Pattern used to find keys that may be meta variable names
+_RAW_META_KEY = r'"((?:theoremnos|xnos)(?:[^"\\]|\\.)*)"\s*:'
+
+# Pattern used to scan raw JSON text for strings that may begin an
+# attributes list, which attach_attrs_span could alter
+_RAW_ATTRS_STR = r'"c"\s*:\s*"\{'
+
+def is_passthrough(text, fmt):
+    """Returns True if filtering the pandoc JSON document `text` for the
+    output format `fmt` would leave it unchanged.  Only the raw text is
+    scanned, and so the check is conservative: False is returned whenever
+    the document might be changed."""
+
+    if not text[:1024].lstrip().startswith('{'):  # Pandoc < 1.18
+        return False
+
+    # Unknown meta variables are warned about
+    if 'xnos' in text or 'theoremnos' in text:
+        import re
+        if any(name not in METANAMES
+               for name in re.findall(_RAW_META_KEY, text)):
+            return False
+
+    if 'theoremnos-names' not in text:  # No theorem types are defined
+        return True
+
+    # Header-includes are always added for LaTeX.  References are only
+    # replaced when theorems are defined in the document (or index).
+    if fmt in ('latex', 'beamer') or '"DefinitionList"' in text or \
+      'theoremnos-index' in text:
+        return False
+
+    # Check that there is nothing for attach_attrs_span to do.  Images
+    # alone in paragraphs may be altered, but the order of the keys in
+    # elements varies, and so any image is taken as a change.
+    if '"Image"' in text:
+        return False
+    if '"Span"' in text:
+        import re
+        if re.search(_RAW_ATTRS_STR, text):
+            return False
+    return True
+
+
+# Client ---------------------------------------------------------------------
+
+def socket_dir():
+    """Returns the directory for the server's unix socket.  This is
+    $XDG_RUNTIME_DIR, which is private to the user, if it is set.
+    Otherwise it is a directory in the temporary directory that the server
+    creates with mode 0700."""
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.environ['XDG_RUNTIME_DIR']
+    import tempfile
+    uid = os.getuid() if hasattr(os, 'getuid') else 0
+    return os.path.join(tempfile.gettempdir(), 'pandoc-theoremnos-%d' % uid)
+
+def socket_path():
+    """Returns the path of the server's unix socket."""
+    if 'THEOREMNOS_SOCKET' in os.environ:
+        return os.environ['THEOREMNOS_SOCKET']
+    return os.path.join(socket_dir(), 'pandoc-theoremnos.sock')
+
+# The environment variables that are passed to the server, which applies
+# them to the request in place of its own
+SETTINGS = ('THEOREMNOS_CACHE', 'THEOREMNOS_CACHE_DIR',
+            'THEOREMNOS_CACHE_SIZE', 'THEOREMNOS_JOBS', 'THEOREMNOS_JSON')
+
+def get_settings():
+    """Returns a dict of the SETTINGS given in the environment."""
+    settings = dict((name, os.environ[name]) for name in SETTINGS
+                    if name in os.environ)
+    if settings.get('THEOREMNOS_CACHE_DIR'):  # The server's cwd differs
+        settings['THEOREMNOS_CACHE_DIR'] = \
+          os.path.abspath(settings['THEOREMNOS_CACHE_DIR'])
+    return settings
+
+def read_message(rfile):
+    """Reads a message from the binary file `rfile`.  Returns the header
+    dict and the body bytes."""
+    import json
+    line = rfile.readline()
+    if not line:
+        raise IOError('Connection closed before a header was received')
+    header = json.loads(line.decode('utf-8'))
+    body = rfile.read(header.get('length', 0))
+    return header, body
+
+def write_message(wfile, header, body=b''):
+    """Writes a message with the `header` dict and `body` bytes to the
+    binary file `wfile`."""
+    import json
+    header = dict(header, length=len(body))
+    wfile.write(json.dumps(header).encode('utf-8') + b'\n')
+    wfile.write(body)
+    wfile.flush()
+
+def request(path, fmt, data, pandocversion=None, settings=None):
+    """Asks the server listening on `path` to filter the document `data`
+    (bytes) for the output format `fmt`, using the `settings` dict (see
+    get_settings()).  Returns the filtered document (bytes).  Warnings
+    from the filter are written to stderr.  Raises socket.error if the
+    server cannot be reached.  A socket owned by another user is never
+    used."""
+    import socket
+    if hasattr(os, 'getuid') and os.stat(path).st_uid != os.getuid():
+        raise RuntimeError('%s is owned by another user' % path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        f = sock.makefile('rwb')
+        write_message(f, {'fmt': fmt, 'pandocversion': pandocversion,
+                          'settings': settings or {}}, data)
+        header, body = read_message(f)
+        f.close()
+    finally:
+        sock.close()
+    if header.get('stderr'):
+        sys.stderr.write(header['stderr'])
+        sys.stderr.flush()
+    if header['status'] != 'ok':
+        raise RuntimeError(header.get('message', 'Unknown server error'))
+    return body
+
+
+def main():
+    """Filters the document AST using the server, if there is one."""
+
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    # Pandoc calls filters with the output format as the only argument
+    if len(sys.argv) < 2 or sys.argv[1].startswith('-'):
+        sys.stderr.write('usage: pandoc-theoremnos-client fmt\n')
+        sys.exit(2)
+    fmt = sys.argv[1]
+
+    # Streaming and profiling apply to this process
+    if os.environ.get('THEOREMNOS_STREAM') or \
+      os.environ.get('THEOREMNOS_PROFILE'):
+        import pandoc_theoremnos
+        pandoc_theoremnos.main()
+        return
+
+    data = stdin.read()
+
+    try:
+        out = request(socket_path(), fmt, data,
+                      os.environ.get('PANDOC_VERSION'), get_settings())
+    except EnvironmentError:  # No server; filter the doc ourselves
+        import pandoc_theoremnos
+        pandoc_theoremnos.main(
+            io.TextIOWrapper(io.BytesIO(data), 'utf-8', 'strict'))
+        return
+    except RuntimeError as e:  # The server failed or is not ours
+        sys.stderr.write('pandoc-theoremnos-client: %s\n' % e)
+        sys.exit(1)
+
+    stdout.write(out)
+    stdout.flush()
+
+
+# Filter ---------------------------------------------------------------------
+
+# Commands run by pandoc_theoremnos.main() instead of the filter
+COMMANDS = ('serve', 'batch')
+
+def filter_main():
+    """Filters the document AST.  Documents with nothing to filter are
+    written back unchanged; the rest are filtered by
+    pandoc_theoremnos.main()."""
+
+    # Only a plain filter call (i.e., from pandoc) takes the short cut
+    args = sys.argv[1:]
+    if len(args) != 1 or args[0].startswith('-') or args[0] in COMMANDS or \
+      os.environ.get('THEOREMNOS_STREAM') or \
+      os.environ.get('THEOREMNOS_PROFILE'):
+        import pandoc_theoremnos
+        pandoc_theoremnos.main()
+        return
+
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    data = stdin.read()
+    if is_passthrough(data.decode('utf-8'), args[0]):
+        stdout.write(data)
+        stdout.flush()
+        return
+
+    import pandoc_theoremnos
+    pandoc_theoremnos.main(
+        io.TextIOWrapper(io.BytesIO(data), 'utf-8', 'strict'))
+
+if __name__ == '__main__':
+    main()
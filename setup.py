@@ -47,8 +47,10 @@ setup(
 
     install_requires=['pandoc-xnos~=2.3.0, < 3.0'],
 
-    py_modules=['pandoc_theoremnos'],
-    entry_points={'console_scripts':['pandoc-theoremnos = pandoc_theoremnos:main']},
+    py_modules=['pandoc_theoremnos', 'pandoc_theoremnos_client'],
+    entry_points={'console_scripts':[
+        'pandoc-theoremnos = pandoc_theoremnos_client:filter_main',
+        'pandoc-theoremnos-client = pandoc_theoremnos_client:main']},
 
     classifiers=[
         'Development Status :: 5 - Production/Stable',